@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# -*- coding: iso-8859-1 -*-
+"""Timings per document and per phase, turned on by the -l flag. A phase
+includes the phases started inside it, and a phase that runs many times
+for a document (like reference parsing) is summed"""
+
+#Libs
+import os
+import csv
+import json
+import math
+import time
+import socket
+
+#Own libs
+import config
+import Util
+
+__scriptDir__ = os.getcwd()
+
+# The record for the document that this process is working on
+_current = None
+
+def start(doc, method):
+	"""Starts a new record, the earlier one is dropped if it's not finished"""
+	global _current
+	if not config.benchmark:
+		return
+	_current = {'doc': doc,
+				'method': method,
+				'started': time.time(),
+				'total': None,
+				'error': False,
+				'phases': {},
+				'sizes': {}}
+
+def finish(error=False):
+	"""Ends the record for the current document and returns it"""
+	global _current
+	record = _current
+	_current = None
+	if record is None:
+		return None
+	record['total'] = time.time() - record.pop('started')
+	record['error'] = error
+	return record
+
+def size(name, n):
+	"""Adds n to an input size (chars or bytes) of the current document"""
+	if _current is not None:
+		_current['sizes'][name] = _current['sizes'].get(name, 0) + n
+
+class _Phase(object):
+	def __init__(self, name):
+		self.name = name
+
+	def __enter__(self):
+		self.started = time.time()
+		return self
+
+	def __exit__(self, excType, excValue, tb):
+		if _current is not None:
+			phases = _current['phases']
+			phases[self.name] = phases.get(self.name, 0.0) + time.time() - self.started
+		return False
+
+class _NoPhase(object):
+	def __enter__(self):
+		return self
+
+	def __exit__(self, excType, excValue, tb):
+		return False
+
+_noPhase = _NoPhase()
+
+def phase(name):
+	"""Times a with block as a phase of the current document"""
+	if _current is None:
+		return _noPhase
+	return _Phase(name)
+
+def percentile(values, p):
+	"""Nearest rank percentile of a sorted list"""
+	if not values:
+		return None
+	i = int(math.ceil(p / 100.0 * len(values))) - 1
+	return values[min(max(i, 0), len(values) - 1)]
+
+def summary(records, top=10):
+	"""Returns the percentiles for the total and every phase, and the
+	slowest documents, as lines of text"""
+	records = [r for r in records if r is not None]
+	names = sorted(set([n for r in records for n in r['phases']]))
+	lines = ['%-16s %6s %9s %9s %9s %9s %10s' % ('phase', 'docs', 'p50', 'p90', 'p99', 'max', 'sum')]
+	for name in ['total'] + names:
+		if name == 'total':
+			values = sorted([r['total'] for r in records])
+		else:
+			values = sorted([r['phases'][name] for r in records if name in r['phases']])
+		if not values:
+			continue
+		lines.append('%-16s %6d %9.3f %9.3f %9.3f %9.3f %10.3f' % (
+			name, len(values), percentile(values, 50), percentile(values, 90),
+			percentile(values, 99), values[-1], sum(values)))
+
+	lines.append('')
+	lines.append('%d slowest documents:' % min(top, len(records)))
+	for r in sorted(records, key=lambda r: -r['total'])[:top]:
+		phases = sorted(r['phases'].items(), key=lambda x: -x[1])
+		lines.append('%9.3f %-20s %s%s' % (
+			r['total'], r['doc'],
+			', '.join(['%s %.3f' % p for p in phases]),
+			' (failed)' if r['error'] else ''))
+	return lines
+
+def write(records, filename):
+	"""Writes the records as JSON or CSV, depending on the file suffix"""
+	records = [r for r in records if r is not None]
+	Util.checkDir(filename)
+	if filename.endswith('.json'):
+		f = open(filename, 'w')
+		json.dump(records, f, indent=1)
+		f.close()
+		return
+
+	phases = sorted(set([n for r in records for n in r['phases']]))
+	sizes = sorted(set([n for r in records for n in r['sizes']]))
+	f = open(filename, 'wb')
+	w = csv.writer(f)
+	w.writerow(['doc', 'method', 'total', 'error'] + phases +
+			   ['size:%s' % s for s in sizes])
+	for r in records:
+		w.writerow([r['doc'].encode('utf-8'), r['method'], '%.6f' % r['total'], int(r['error'])] +
+				   ['%.6f' % r['phases'][p] if p in r['phases'] else '' for p in phases] +
+				   [r['sizes'].get(s, '') for s in sizes])
+	f.close()
+
+def logName(method):
+	"""A file name in logs/ like the ones from the old print based log"""
+	return os.path.join(__scriptDir__, 'logs', 'benchmark_%s_%s_%s.%s' % (
+		method, socket.gethostname().split('.')[0],
+		time.strftime('%Y%m%d_%H%M%S'), config.benchmarkFormat))
+
+def report(records, method):
+	"""Writes the records to logs/ and prints the summary"""
+	filename = logName(method)
+	write(records, filename)
+	print
+	print "\n".join(summary(records, config.benchmarkTop))
+	print "Timings written to %s" % Util.relpath(filename)
+
+def loadCorpus(module):
+	"""Returns the document ids in the pinned corpus etc/benchmark.<module>.txt"""
+	ids = []
+	for line in open(os.path.join(__scriptDir__, 'etc', 'benchmark.%s.txt' % module)):
+		line = line.split('#')[0].strip()
+		if line:
+			ids.append(line.decode('utf-8'))
+	return ids
@@ -94,6 +94,19 @@ class Controller:
 	def GenerateAll(self, module='all'):
 		self._action('GenerateAll', module)
 
+	def BuildAll(self, module='all'):
+		"""Parse and generate in one pass, without reading the parsed files back"""
+		self._action('BuildAll', module)
+
+	def Benchmark(self, module='all'):
+		"""Parse the pinned corpus and report the time of each phase"""
+		self._action('Benchmark', module)
+
+	def BuildKnowledgeBase(self):
+		"""Compiles the RDF files in etc/ to the lookup file used by the parsers"""
+		import KnowledgeBase
+		print "Compiled %s" % KnowledgeBase.build()
+
 
 	def _validate(self, argv):
 
@@ -129,12 +142,12 @@ class Controller:
 										   and callable(getattr(self, m)))]
 	        )
 def usage():
-	print "Usage: pyhton Controller.py [-d | -h | -l] [arg]"
-	print "Available flags are: -d (debug), -h--help (help), -l(log benchmark)"
+	print "Usage: pyhton Controller.py [-d | -f | -h | -l | -p N | -s | --resume] [arg]"
+	print "Available flags are: -d (debug), -f (force), -h--help (help), -l(log benchmark), -p N(run with N processes), -s (reference parser stats), --resume (skip documents finished by the last run)"
 
 def main(args):
 	try:                                
-		opts, args = getopt.getopt(args, 'dhl', 'help')
+		opts, args = getopt.getopt(args, 'dfhlp:s', ['help', 'resume'])
 	except getopt.GetoptError:           
 		usage()                          
 		sys.exit(2)
@@ -145,8 +158,20 @@ def main(args):
 			sys.exit()                  
 		elif opt == '-d':                         
 			config.debug = 1
+		elif opt == '-f':
+			config.force = 1
 		elif opt == '-l':
 			config.benchmark = 1
+		elif opt == '--resume':
+			config.resume = 1
+		elif opt == '-s':
+			config.referenceStats = 1
+		elif opt == '-p':
+			try:
+				config.processes = int(arg)
+			except ValueError:
+				usage()
+				sys.exit(2)
 	
 	ctrl = Controller()
 	ctrl._validate(args)
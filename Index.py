@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# -*- coding: iso-8859-1 -*-
+"""Lookup structures for finding known labels in text"""
+
+#Libs
+import difflib
+from collections import defaultdict, deque
+
+class PrefixTrie(object):
+	"""A trie of case folded keys. Finds the longest key that is a prefix
+	of a string in time proportional to the length of the key"""
+	def __init__(self, items=()):
+		self.root = {}
+		for (key, value) in items:
+			self.add(key, value)
+
+	def add(self, key, value):
+		node = self.root
+		for c in key.lower():
+			node = node.setdefault(c, {})
+		# None can't be a character, so it marks the end of a key
+		node[None] = value
+
+	def longestPrefix(self, s, default=None):
+		"""Returns the value for the longest key that s starts with"""
+		node = self.root
+		res = node.get(None, default)
+		for c in s.lower():
+			node = node.get(c)
+			if node is None:
+				break
+			if None in node:
+				res = node[None]
+		return res
+
+class NgramIndex(object):
+	"""Finds the key that is most similar to a string. Only the keys that
+	shares the most n-grams with the string are compared with difflib"""
+	def __init__(self, keys=(), n=3, candidates=5):
+		self.n = n
+		self.candidates = candidates
+		self.index = defaultdict(list)
+		for key in keys:
+			self.add(key)
+
+	def ngrams(self, s):
+		s = s.lower()
+		if len(s) <= self.n:
+			return set([s])
+		return set([s[i:i + self.n] for i in range(len(s) - self.n + 1)])
+
+	def add(self, key):
+		for gram in self.ngrams(key):
+			self.index[gram].append(key)
+
+	def closeMatch(self, s, cutoff=0.8):
+		"""Like difflib.get_close_matches(s, keys, 1, cutoff) but case
+		folded, returns the key or None"""
+		shared = defaultdict(int)
+		for gram in self.ngrams(s):
+			for key in self.index.get(gram, ()):
+				shared[key] += 1
+		if not shared:
+			return None
+
+		best = sorted(shared.items(), key=lambda x: -x[1])[:self.candidates]
+		matcher = difflib.SequenceMatcher()
+		matcher.set_seq2(s.lower())
+		res = None
+		resRatio = cutoff
+		for (key, count) in best:
+			matcher.set_seq1(key.lower())
+			if (matcher.real_quick_ratio() >= resRatio and
+				matcher.quick_ratio() >= resRatio):
+				ratio = matcher.ratio()
+				if ratio >= resRatio:
+					res = key
+					resRatio = ratio
+		return res
+
+class AhoCorasick(object):
+	"""An Aho-Corasick automaton of case folded keys. Finds every key that 
+	occurs in a string in one pass over it"""
+	def __init__(self, keys=()):
+		self.goto = [{}]
+		self.fail = [0]
+		self.out = [()]
+		for key in keys:
+			self._add(key.lower())
+		self._build()
+
+	def _add(self, key):
+		state = 0
+		for c in key:
+			if c not in self.goto[state]:
+				self.goto.append({})
+				self.fail.append(0)
+				self.out.append(())
+				self.goto[state][c] = len(self.goto) - 1
+			state = self.goto[state][c]
+		self.out[state] = (key,)
+
+	def _build(self):
+		"""Sets the fail links breadth first, the keys that end in a state
+		includes the ones that end in its fail state"""
+		queue = deque(self.goto[0].values())
+		while queue:
+			state = queue.popleft()
+			for (c, next) in self.goto[state].items():
+				queue.append(next)
+				f = self.fail[state]
+				while f and c not in self.goto[f]:
+					f = self.fail[f]
+				self.fail[next] = self.goto[f].get(c, 0)
+				self.out[next] += self.out[self.fail[next]]
+
+	def findAll(self, s):
+		"""Returns (start, end, key) for every occurrence of a key in s"""
+		res = []
+		state = 0
+		for (i, c) in enumerate(s.lower()):
+			while state and c not in self.goto[state]:
+				state = self.fail[state]
+			state = self.goto[state].get(c, 0)
+			for key in self.out[state]:
+				res.append((i + 1 - len(key), i + 1, key))
+		return res
+
+	def search(self, s):
+		"""True if any key occurs in s"""
+		state = 0
+		for c in s.lower():
+			while state and c not in self.goto[state]:
+				state = self.fail[state]
+			state = self.goto[state].get(c, 0)
+			if self.out[state]:
+				return True
+		return False
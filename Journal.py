@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# -*- coding: iso-8859-1 -*-
+"""Run journal, a line for each document that a run has finished or
+failed. It's written as the run goes, so a run that is interrupted or
+has failed documents can be resumed with --resume"""
+
+#Libs
+import json
+
+#Own libs
+import Util
+
+class Journal(object):
+	"""The documents of a run, the file has one JSON object per line"""
+	def __init__(self, filename, resume=False):
+		self.filename = filename
+		self.done = set()
+		self.failed = {}
+		if resume:
+			self._load()
+		Util.checkDir(filename)
+		self.f = open(filename, 'a' if resume else 'w')
+
+	def _load(self):
+		"""Reads the journal of the earlier run, a later line for a
+		document replaces the earlier ones"""
+		try:
+			f = open(self.filename)
+		except IOError:
+			return
+		for line in f:
+			try:
+				entry = json.loads(line)
+			except ValueError:
+				# The last line of a run that was killed
+				continue
+			if entry['status'] == 'done':
+				self.done.add(entry['id'])
+				self.failed.pop(entry['id'], None)
+			else:
+				self.done.discard(entry['id'])
+				self.failed[entry['id']] = entry['error']
+		f.close()
+
+	def pending(self, files):
+		"""The files that aren't done, failed files are tried again"""
+		return [f for f in files if f not in self.done]
+
+	def finish(self, id):
+		self.done.add(id)
+		self.failed.pop(id, None)
+		self._write({'id': id, 'status': 'done'})
+
+	def fail(self, id, error):
+		"""Records that id failed, error is the traceback"""
+		self.done.discard(id)
+		self.failed[id] = error
+		self._write({'id': id, 'status': 'failed', 'error': error})
+
+	def _write(self, entry):
+		self.f.write(json.dumps(entry) + '\n')
+		self.f.flush()
+
+	def close(self):
+		self.f.close()
@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+# -*- coding: iso-8859-1 -*-
+"""Lookup tables compiled from the RDF files in etc/. The tables are stored
+in a binary file that is read through mmap, so all processes share the same
+pages and rdflib is only needed when the file is compiled"""
+
+#Libs
+import os
+import mmap
+import struct
+import hashlib
+from tempfile import mktemp
+
+#Own libs
+import Util
+
+__scriptDir__ = os.getcwd()
+
+# The snapshot is compiled again when any of these files change
+SOURCES = ('etc/sfs-extra.n3', 'etc/authrec.n3')
+
+SNAPSHOT = 'knowledgebase.bin'
+
+# File layout, integers are unsigned 32 bit little endian:
+#   header: magic, sha1 of SOURCES, number of tables
+#   one entry per table: name, number of items, offset of the index
+#   one index per table: (key offset, key length, value offset, value
+#   length) for each item, sorted on the key
+#   the strings, utf-8 encoded
+MAGIC = 'LPKB0001'
+HEADER = struct.Struct('<8s20sI')
+TABLE = struct.Struct('<16sII')
+ITEM = struct.Struct('<IIII')
+
+class KnowledgeBaseError(Exception):
+	pass
+
+class Table(object):
+	"""A read only dict of unicode keys and values in a compiled snapshot"""
+	def __init__(self, data, count, offset):
+		self.data = data
+		self.count = count
+		self.offset = offset
+
+	def __len__(self):
+		return self.count
+
+	def __iter__(self):
+		for i in range(self.count):
+			yield self._key(i)
+
+	def __contains__(self, key):
+		return self._find(key) != None
+
+	def __getitem__(self, key):
+		i = self._find(key)
+		if i == None:
+			raise KeyError(key)
+		return self._value(i)
+
+	def has_key(self, key):
+		return key in self
+
+	def get(self, key, default=None):
+		i = self._find(key)
+		if i == None:
+			return default
+		return self._value(i)
+
+	def keys(self):
+		return list(self)
+
+	def items(self):
+		return [(self._key(i), self._value(i)) for i in range(self.count)]
+
+	def _item(self, i):
+		return ITEM.unpack_from(self.data, self.offset + i * ITEM.size)
+
+	def _rawKey(self, i):
+		(keyOffset, keyLength, valOffset, valLength) = self._item(i)
+		return self.data[keyOffset:keyOffset + keyLength]
+
+	def _key(self, i):
+		return self._rawKey(i).decode('utf-8')
+
+	def _value(self, i):
+		(keyOffset, keyLength, valOffset, valLength) = self._item(i)
+		return self.data[valOffset:valOffset + valLength].decode('utf-8')
+
+	def _find(self, key):
+		"""Binary search for the index of key"""
+		if isinstance(key, unicode):
+			key = key.encode('utf-8')
+		lo = 0
+		hi = self.count
+		while lo < hi:
+			mid = (lo + hi) // 2
+			k = self._rawKey(mid)
+			if k < key:
+				lo = mid + 1
+			elif k > key:
+				hi = mid
+			else:
+				return mid
+		return None
+
+class KnowledgeBase(object):
+	"""A compiled snapshot, opened read only through mmap"""
+	def __init__(self, filename):
+		f = open(filename, 'rb')
+		try:
+			# An empty file can't be mapped
+			if os.fstat(f.fileno()).st_size < HEADER.size:
+				raise KnowledgeBaseError('%s is too short' % filename)
+			self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		finally:
+			f.close()
+
+		(magic, self.digest, count) = HEADER.unpack_from(self.data, 0)
+		if magic != MAGIC:
+			raise KnowledgeBaseError('%s is not a compiled knowledge base' % filename)
+		if HEADER.size + count * TABLE.size > len(self.data):
+			raise KnowledgeBaseError('%s is truncated' % filename)
+
+		self.tables = {}
+		for i in range(count):
+			(name, items, offset) = TABLE.unpack_from(self.data, HEADER.size + i * TABLE.size)
+			table = Table(self.data, items, offset)
+			self._check(filename, table)
+			self.tables[name.rstrip('\0')] = table
+
+	def _check(self, filename, table):
+		"""Raises KnowledgeBaseError if the index or the strings of the 
+		table are outside the file, as when it's truncated"""
+		if table.offset + table.count * ITEM.size > len(self.data):
+			raise KnowledgeBaseError('%s is truncated' % filename)
+		for i in range(table.count):
+			(keyOffset, keyLength, valOffset, valLength) = table._item(i)
+			if (keyOffset + keyLength > len(self.data) or
+				valOffset + valLength > len(self.data)):
+				raise KnowledgeBaseError('%s is truncated' % filename)
+
+	def table(self, name):
+		return self.tables[name]
+
+def sourceDigest():
+	"""Returns the sha1 of the source files"""
+	h = hashlib.sha1()
+	for source in SOURCES:
+		f = open(os.path.join(__scriptDir__, source), 'rb')
+		h.update(f.read())
+		f.close()
+	return h.digest()
+
+def readSources():
+	"""Reads the lookup tables from the RDF files, returns a dict of dicts"""
+	from rdflib import RDFS, Namespace
+	from rdflib.Graph import Graph
+
+	DCT = Namespace(Util.ns['dct'])
+
+	g = Graph()
+	g.load(Util.relpath(os.path.join(__scriptDir__, 'etc/sfs-extra.n3')), format='n3')
+	labels = {}
+	for uri, label in g.subject_objects(RDFS.label):
+		labels[unicode(label)] = unicode(uri)
+	alternates = {}
+	for uri, alternate in g.subject_objects(DCT['alternate']):
+		alternates[unicode(uri)] = unicode(alternate)
+
+	g = Graph()
+	g.load(Util.relpath(os.path.join(__scriptDir__, 'etc/authrec.n3')), format='n3')
+	authRec = {}
+	for uri, label in g.subject_objects(RDFS.label):
+		authRec[unicode(label)] = unicode(uri)
+
+	return {'label': labels,
+			'alternate': alternates,
+			'authrec': authRec}
+
+def build(filename=None):
+	"""Compiles the RDF files in SOURCES to a snapshot"""
+	if not filename:
+		filename = Util.cacheFile(SNAPSHOT)
+	tables = readSources()
+	names = sorted(tables.keys())
+
+	strings = []
+	stringOffset = HEADER.size + len(names) * TABLE.size
+	stringOffset += sum([len(tables[n]) for n in names]) * ITEM.size
+
+	header = [HEADER.pack(MAGIC, sourceDigest(), len(names))]
+	indexes = []
+	indexOffset = HEADER.size + len(names) * TABLE.size
+	for name in names:
+		items = sorted([(k.encode('utf-8'), v.encode('utf-8'))
+						for (k, v) in tables[name].items()])
+		header.append(TABLE.pack(name, len(items), indexOffset))
+		for (key, val) in items:
+			indexes.append(ITEM.pack(stringOffset, len(key),
+									 stringOffset + len(key), len(val)))
+			strings.append(key)
+			strings.append(val)
+			stringOffset += len(key) + len(val)
+		indexOffset += len(items) * ITEM.size
+
+	# Written to a temp file first, other processes might have it open
+	Util.checkDir(filename)
+	tmpFile = mktemp(dir=os.path.dirname(filename))
+	f = open(tmpFile, 'wb')
+	f.write(''.join(header + indexes + strings))
+	f.close()
+	os.rename(tmpFile, filename)
+	return filename
+
+_shared = None
+
+def load():
+	"""Returns the snapshot shared by this process. It's compiled first if
+	it's missing or the source files have changed"""
+	global _shared
+	if _shared is None:
+		filename = Util.cacheFile(SNAPSHOT)
+		kb = None
+		if os.path.exists(filename):
+			try:
+				kb = KnowledgeBase(filename)
+			except (KnowledgeBaseError, ValueError, struct.error, EnvironmentError):
+				# Compiled again below
+				kb = None
+		if kb is None or kb.digest != sourceDigest():
+			kb = KnowledgeBase(build(filename))
+		_shared = kb
+	return _shared
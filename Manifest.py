@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# -*- coding: iso-8859-1 -*-
+"""Build manifest, records the content hashes that each document was
+built from so unchanged documents can be skipped"""
+
+#Libs
+import os
+import glob
+import sqlite3
+import hashlib
+
+#Own libs
+import Util
+
+__scriptDir__ = os.getcwd()
+
+def hashString(s):
+	if isinstance(s, unicode):
+		s = s.encode('utf-8')
+	return hashlib.sha1(s).hexdigest()
+
+def hashFile(filename):
+	"""Returns the sha1 of the file content, None if there's no such file"""
+	try:
+		f = open(filename, 'rb')
+	except IOError:
+		return None
+	h = hashlib.sha1()
+	chunk = f.read(1024*1024)
+	while chunk:
+		h.update(chunk)
+		chunk = f.read(1024*1024)
+	f.close()
+	return h.hexdigest()
+
+def hashInputs(files, baseDir):
+	"""Returns a string with the name and hash of each file, names are
+	relative to baseDir so the data dir can be moved"""
+	return u'\n'.join([u'%s %s' % (os.path.relpath(f, baseDir), hashFile(f))
+					   for f in sorted(files)])
+
+# Versions by glob patterns, the source files don't change during a run
+_versions = {}
+
+def sourceVersion(patterns):
+	"""Returns a hash of all the files, relative to the script dir, that
+	matches the glob patterns"""
+	patterns = tuple(patterns)
+	if patterns not in _versions:
+		h = hashlib.sha1()
+		for pattern in patterns:
+			for f in sorted(glob.glob(os.path.join(__scriptDir__, pattern))):
+				h.update(os.path.basename(f))
+				h.update(hashFile(f))
+		_versions[patterns] = h.hexdigest()
+	return _versions[patterns]
+
+class Manifest(object):
+	"""A SQLite file with one row per document and action (Parse, Generate..)"""
+	def __init__(self, filename):
+		Util.checkDir(filename)
+		# Worker processes share the file, wait for each others locks
+		self.db = sqlite3.connect(filename, timeout=60)
+		self.db.execute('CREATE TABLE IF NOT EXISTS build ('
+						'id TEXT, action TEXT, inputs TEXT, '
+						'version TEXT, output TEXT, '
+						'PRIMARY KEY (id, action))')
+		self.db.commit()
+
+	def isUpToDate(self, id, action, inputs, version, outfile):
+		"""True if id was built from the same inputs by the same version,
+		and outfile is still what was built then"""
+		row = self.db.execute('SELECT inputs, version, output FROM build '
+							  'WHERE id = ? AND action = ?', (id, action)).fetchone()
+		if row is None:
+			return False
+		if row[0] != inputs or row[1] != version:
+			return False
+		return row[2] == hashFile(outfile)
+
+	def record(self, id, action, inputs, version, output):
+		self.db.execute('INSERT OR REPLACE INTO build VALUES (?, ?, ?, ?, ?)',
+						(id, action, inputs, version, output))
+		self.db.commit()
+
+	def forget(self, id):
+		self.db.execute('DELETE FROM build WHERE id = ?', (id,))
+		self.db.commit()
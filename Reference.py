@@ -6,16 +6,27 @@
 import sys
 import os
 import re
+import glob
+import time
+import cPickle
+import hashlib
+import multiprocessing.util
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
 
 #3rd party libs
-from rdflib.Graph import Graph
-from rdflib import RDF, RDFS, URIRef, Namespace, Literal
 from simpleparse.parser import Parser
 from simpleparse.stt.TextTools.TextTools import tag
 
 #Own libs
 from Dispatcher import Dispatcher
+import config
 import Util
+import Index
+import KnowledgeBase
+import Benchmark
+import Stats
 from DataObjects import UnicodeStructure, PredicateType
 
 SP_CHARSET = 'iso-8859-1'
@@ -29,28 +40,139 @@ class Link(UnicodeStructure):
 class LinkSubject(PredicateType, Link):
 	pass
 
-class NodeTree:
-	"""Encapsulates the node structure from mx.TextTools in a tree interface"""
-	def __init__(self, root, data, offset=0, isRoot=True):
+class TagTree(object):
+	"""The tag list from mx.TextTools as flat arrays, with the nodes in 
+	preorder. Node 0 is the root and the descendants of node i are the 
+	nodes i+1 to last[i]. If the source of data is given, marks has the 
+	offsets in data after each char that was inserted into the source, 
+	and the texts of the nodes are sliced from the source"""
+	def __init__(self, tagList, data, source=None, marks=None):
 		self.data = data
-		self.root = root
-		self.isRoot = isRoot
-		self.offset = offset 
-
-	def __getattr__(self, name):
-		if name == 'text':
-			return self.data.decode(SP_CHARSET)
-		elif name == 'tag':
-			return (self.isRoot and 'root' or self.root[0])
-		elif name == 'nodes':
-			res = []
-			l = (self.isRoot and self.root[1] or self.root[3])
-			if l:
-				for p in l:
-					res.append(NodeTree(p, self.data[p[1]-self.offset:p[2]-self.offset], p[1], False))
-			return res
-		else:
-			raise AttributeError
+		self.source = source
+		self.marks = marks
+		self.tagNames = []
+		self.tagIds = {}
+		self.tag = array('i')
+		self.start = array('i')
+		self.end = array('i')
+		self.parent = array('i')
+		self.firstChild = array('i')
+		self.nextSibling = array('i')
+		self.last = array('i')
+		# Node ids by tag name, in preorder
+		self.index = defaultdict(list)
+
+		self._append('root', 0, len(data), -1)
+		stack = [(0, iter(tagList[1] or ()), -1)]
+		while stack:
+			(parent, children, prev) = stack[-1]
+			child = next(children, None)
+			if child is None:
+				self.last[parent] = len(self.tag) - 1
+				stack.pop()
+				continue
+			i = self._append(child[0], child[1], child[2], parent)
+			if prev == -1:
+				self.firstChild[parent] = i
+			else:
+				self.nextSibling[prev] = i
+			stack[-1] = (parent, children, i)
+			stack.append((i, iter(child[3] or ()), -1))
+
+	def _append(self, tagName, start, end, parent):
+		if tagName not in self.tagIds:
+			self.tagIds[tagName] = len(self.tagNames)
+			self.tagNames.append(tagName)
+		i = len(self.tag)
+		self.tag.append(self.tagIds[tagName])
+		self.start.append(start)
+		self.end.append(end)
+		self.parent.append(parent)
+		self.firstChild.append(-1)
+		self.nextSibling.append(-1)
+		self.last.append(i)
+		self.index[tagName].append(i)
+		return i
+
+	def root(self):
+		return Node(self, 0)
+
+	def text(self, i):
+		if self.source is None:
+			return self.data[self.start[i]:self.end[i]].decode(SP_CHARSET)
+		return self.source[self.origin(self.start[i]):self.origin(self.end[i])]
+
+	def origin(self, offset):
+		"""The offset in the source for an offset in data"""
+		return offset - bisect_right(self.marks, offset)
+
+	def find(self, i, tagName):
+		"""Returns the first node with the tag in the subtree of node i"""
+		ids = self.index.get(tagName)
+		if ids:
+			j = bisect_left(ids, i)
+			if j < len(ids) and ids[j] <= self.last[i]:
+				return Node(self, ids[j])
+		return None
+
+	def findAll(self, i, tagName):
+		"""Returns the nodes with the tag in the subtree of node i, but not 
+		the ones inside another node with the tag"""
+		res = []
+		ids = self.index.get(tagName)
+		if ids:
+			end = -1
+			for j in ids[bisect_left(ids, i):]:
+				if j > self.last[i]:
+					break
+				if j > end:
+					res.append(Node(self, j))
+					end = self.last[j]
+		return res
+
+class Node(object):
+	"""A view of a node in a TagTree"""
+	__slots__ = ('tree', 'id')
+
+	def __init__(self, tree, id):
+		self.tree = tree
+		self.id = id
+
+	@property
+	def tag(self):
+		return self.tree.tagNames[self.tree.tag[self.id]]
+
+	@property
+	def start(self):
+		return self.tree.start[self.id]
+
+	@property
+	def end(self):
+		return self.tree.end[self.id]
+
+	@property
+	def data(self):
+		return self.tree.data[self.tree.start[self.id]:self.tree.end[self.id]]
+
+	@property
+	def text(self):
+		return self.tree.text(self.id)
+
+	@property
+	def nodes(self):
+		res = []
+		i = self.tree.firstChild[self.id]
+		while i != -1:
+			res.append(Node(self.tree, i))
+			i = self.tree.nextSibling[i]
+		return res
+
+	def descendants(self):
+		"""The ids of this node and all nodes below it, in preorder"""
+		return xrange(self.id, self.tree.last[self.id] + 1)
+
+# Marks that lastLaw hasn't been set while a reference is parsed
+_noLaw = object()
 
 class ParseError(Exception):
 	def __init__(self, value):
@@ -71,18 +193,165 @@ class Reference:
 	reDescapeCompound 	= re.compile(r'\b(\w+-)_(och)_(\w+-?)(lagen|frordningen)\b', re.UNICODE)
 	reDescapeNamed 		= re.compile(r'\|(lagens?|balkens?|frordningens?|formens?|ordningens?|kungrelsens?|stadgans?)')
 	reXmlCharref		= re.compile('&#\d+;')
+	# A production in an EBNF file, and what in its body isn't a name
+	reProduction		= re.compile(r'^\s*(\w+)\s*::=(.*)$', re.MULTILINE)
+	reLiteral			= re.compile(r"'[^']*'|\"[^\"]*\"|\[[^\]]*\]|#.*")
+
+	# The texts of the results are sliced from the text that is parsed 
+	# instead of rewriting the tagged text back, the marks for named laws 
+	# are kept as offsets. Texts where the rewrite could change more than
+	# the marks, with chars that are escaped or that looks like the marks,
+	# are rewritten as before
+	offsetMap			= True
+	reRewrite			= re.compile(u'&#|\||_och_|[^\x00-\xff]')
+	reSameLaw			= re.compile(u'(samma|nmnda) (lag|frordning)')
+
+	# Separates the texts in parseMany, no production but plain accepts it
+	separator			= '~'
+
+	# Every production in the grammars but NamedExternalLawRef contains 
+	# one of these, so a text without any of them and without a named law
+	# would only be tagged as plain
+	lagrumTokens		= [u'', u'kap', u'\d{4}:', u'\|',
+						   u'(frsta|andra|tredje|fjrde|femte|sjtte|sjunde|ttonde|nionde|[1-9])\s+st']
+	# The letters of the char production, except 
+	reLawNameChar		= re.compile(u'[a-zA-Z---]')
+
+	# Used by sfsFormatUri to build the URI fragments
+	pieceMap = {u'frsta'	:'1',
+			  u'andra'	:'2',
+			  u'tredje'	:'3',
+			  u'fjrde'	:'4',
+			  u'femte'	:'5',
+			  u'sjtte'	:'6',
+			  u'sjunde'	:'7',
+			  u'ttonde':'8',
+			  u'nionde'	:'9'}
+	
+	keyMap = {u'lawref'	:'L',
+			  u'chapter':'K',
+			  u'section':'P',
+			  u'piece'	:'S',
+			  u'item'	:'N',
+			  u'itemnumeric': 'N',
+			  u'element':'O',
+			  u'sentence': 'M'}
+	
+	attrOrder = ['law', 'lawref', 'chapter', 'section', 'element', 'piece', 'item', 'itemnumeric', 'sentence']
+
+	# Words that ends like a named law but aren't laws
+	noLaw = frozenset([
+		u'aktieslagen',
+		u'anordningen',
+		u'anordningen',
+		u'anslagen',
+		u'arbetsordningen',
+		u'associationsformen',
+		u'avfallsslagen',
+		u'avslagen',
+		u'avvittringsutslagen',
+		u'bergslagen',
+		u'beskattningsunderlagen',
+		u'bolagen',
+		u'bolagsordningen',
+		u'bolagsordningen',
+		u'dagordningen',
+		u'djurslagen',
+		u'dotterbolagen',
+		u'emballagen',
+		u'energislagen',
+		u'ersttningsformen',
+		u'ersttningsslagen',
+		u'examensordningen',
+		u'finansbolagen',
+		u'finansieringsformen',
+		u'fissionsvederlagen',
+		u'flygbolagen',
+		u'fondbolagen',
+		u'frbundsordningen',
+		u'freslagen',
+		u'fretrdesordningen',
+		u'frhandlingsordningen',
+		u'frlagen',
+		u'frmnsrttsordningen',
+		u'frmgenhetsordningen',
+		u'frordningen',
+		u'frslagen',
+		u'frskringsaktiebolagen',
+		u'frskringsbolagen',
+		u'gravanordningen',
+		u'grundlagen',
+		u'handelsplattformen',
+		u'handlggningsordningen',
+		u'inkomstslagen',
+		u'inkpssamordningen',
+		u'kapitalunderlagen',
+		u'klockslagen',
+		u'kopplingsanordningen',
+		u'lneformen',
+		u'mervrdesskatteordningen',
+		u'nummerordningen',
+		u'omslagen',
+		u'ordalagen',
+		u'pensionsordningen',
+		u'renhllningsordningen',
+		u'representationsreformen',
+		u'rttegngordningen',
+		u'rttegngsordningen',
+		u'rttsordningen',
+		u'samordningen',
+		u'samordningen',
+		u'skatteordningen',
+		u'skatteslagen',
+		u'skatteunderlagen',
+		u'skolformen',
+		u'skyddsanordningen',
+		u'slagen',
+		u'solvrmeanordningen',
+		u'storslagen',
+		u'studieformen',
+		u'stdformen',
+		u'stdordningen',
+		u'stdordningen',
+		u'skerhetsanordningen',
+		u'talarordningen',
+		u'tillslagen',
+		u'tivolianordningen',
+		u'trafikslagen',
+		u'transportanordningen',
+		u'transportslagen',
+		u'trdslagen',
+		u'turordningen',
+		u'underlagen',
+		u'uniformen',
+		u'uppstllningsformen',
+		u'utvecklingsbolagen',
+		u'varuslagen',
+		u'verksamhetsformen',
+		u'vevanordningen',
+		u'vrdformen',
+		u'goanordningen',
+		u'goslagen',
+		u'rendeslagen',
+		u'tgrdsfrslagen'])
+	forarbeteTokens		= [u'prop\.', u'bet\.', u'rskr\.', u'3\d{2}(\d{2})?L\d{4}']
+
+	# Taggers that are built in this process, by grammar hash
+	_taggers = {}
+
+	# The format_ methods by tag for each class, and the attribute that 
+	# each tag in the grammars gives to findAttrs
+	_formatterTables = {}
+	_attrKeys = {}
 
 	def __init__(self, *args):
 		scriptDir = os.getcwd()
 
-		self.graph = Graph()
-		n3File = Util.relpath(scriptDir + '/etc/sfs-extra.n3')
-		self.graph.load(n3File, format='n3')
-
 		self.roots = []
 		self.uriFormatter = {}
 		self.decl = ''
 		self.namedLaws = {}
+		self.namedLawIndex = Index.AhoCorasick()
 		self.loadEbnf(scriptDir + '/etc/base.ebnf')
 		self.args = args
 		
@@ -90,7 +359,9 @@ class Reference:
 			prods = self.loadEbnf(scriptDir + '/etc/lagrum.ebnf')
 			for p in prods: 
 				self.uriFormatter[p] = self.sfsFormatUri
-			self.namedLaws.update(self.getRelationship(RDFS.label))
+			self.namedLaws = KnowledgeBase.load().table('label')
+			self.namedLawIndex = Index.AhoCorasick([l for l in self.namedLaws.keys()
+													if l not in self.noLaw])
 			self.roots.append('sfsrefs')
 			self.roots.append('sfsref')
 
@@ -105,17 +376,137 @@ class Reference:
 			self.roots.append('forarbeteref')
 
 		self.decl += 'root ::= (%s/plain)+\n' % '/'.join(self.roots)
-		self.parser = Parser(self.decl, 'root')
-		self.tagger = self.parser.buildTagger('root')
-		self.depth 	= 0
+
+		# Character references are unescaped even in plain text
+		tokens = [u'&#']
+		if self.LAGRUM in args:
+			tokens.extend(self.lagrumTokens)
+		if self.FORARBETEN in args:
+			tokens.extend(self.forarbeteTokens)
+		self.reToken = re.compile(u'|'.join(tokens), re.IGNORECASE|re.UNICODE)
+		self.fastPath = 0
+
+		cls = self.__class__
+		if cls not in self._formatterTables:
+			self._formatterTables[cls] = dict([(name[7:], getattr(cls, name)) 
+											   for name in dir(cls) 
+											   if name.startswith('format_')])
+		self.formatters = self._formatterTables[cls]
+		self.grammarHash = hashlib.sha1(self.decl).hexdigest()
+		self.tagger = self.loadTagger()
+
+		# Counted in the Stats sections for this grammar, see -s
+		self.stats = config.referenceStats
+		if self.stats:
+			self.statsName = '-'.join(self.roots)
+			# A formatter for a production of another grammar is never 
+			# used here, one for no production at all is never used
+			reachable = self.reachableProductions()
+			defined = set()
+			for f in glob.glob(scriptDir + '/etc/*.ebnf'):
+				defined.update([m.group(1) for m in self.reProduction.finditer(open(f).read())])
+			Stats.declare('productions ' + self.statsName, reachable)
+			Stats.declare('formatters ' + self.statsName, 
+						  [tag for tag in self.formatters.keys() 
+						   if tag in reachable or tag not in defined])
+
+		self.cache = Util.LRUCache(config.referenceCache)
+		self.cacheHits = 0
+		self.cacheMisses = 0
+		if config.referenceCache and config.persistReferenceCache:
+			self.loadCache()
 
 		#SFS specific settings
-		self.currentLaw 		= None
-		self.currentChapter 	= None
-		self.currentSection 	= None
-		self.currentPiece		= None
-		self.lastLaw			= None
-		self.currentNamedLaws	= {}
+		self.reset()
+
+	def reachableProductions(self):
+		"""Returns the productions in self.decl that can be reached from 
+		the root. The formatters are declared for the whole class, but 
+		only these productions can be tagged with this grammar"""
+		rules = {}
+		for m in self.reProduction.finditer(self.decl):
+			rules[m.group(1)] = re.findall(r'\w+', self.reLiteral.sub(' ', m.group(2)))
+		reachable = set()
+		todo = ['root']
+		while todo:
+			name = todo.pop()
+			if name in reachable or name not in rules:
+				continue
+			reachable.add(name)
+			todo.extend(rules[name])
+		return reachable
+
+	def loadTagger(self):
+		"""Returns the tagger for the grammar in self.decl. Building it 
+		is slow, so it's cached both in this process and on disk. The 
+		cache is keyed on the hash of the grammar, so when a EBNF file
+		changes a new tagger is built"""
+		if self.grammarHash in self._taggers:
+			return self._taggers[self.grammarHash]
+
+		prefix = 'grammar-%s-' % '-'.join(self.roots)
+		cacheFile = Util.cacheFile(prefix + self.grammarHash + '.pickle')
+		tagger = Util.loadPickle(cacheFile)
+		if tagger is None:
+			tagger = Parser(self.decl, 'root').buildTagger('root')
+			try:
+				Util.dumpPickle(tagger, cacheFile)
+				Util.removeCached(prefix + '*.pickle', keep=cacheFile)
+			except (cPickle.PicklingError, TypeError):
+				# Can't be stored on disk, keep it for this process only
+				pass
+
+		self._taggers[self.grammarHash] = tagger
+		return tagger
+
+	def cacheName(self):
+		"""The file for the persisted cache. Besides the grammar the results
+		depends on the named laws in etc/ and on this file"""
+		h = hashlib.sha1(self.grammarHash)
+		if self.LAGRUM in self.args:
+			h.update(KnowledgeBase.sourceDigest())
+		f = open(os.path.splitext(__file__)[0] + '.py', 'rb')
+		h.update(f.read())
+		f.close()
+		return Util.cacheFile('references-%s-%s.pickle' % ('-'.join(self.roots), h.hexdigest()))
+
+	def loadCache(self):
+		"""Loads the results from earlier runs, they're written back when 
+		the process exits"""
+		entries = Util.loadPickle(self.cacheName())
+		if entries:
+			for (key, result, changes) in entries:
+				res = []
+				for node in result:
+					if isinstance(node, tuple):
+						(text, uri, predicate) = node
+						if predicate is None:
+							node = Link(text, uri=uri)
+						else:
+							node = LinkSubject(text, uri=uri, predicate=predicate)
+					res.append(node)
+				self.cache[key] = (tuple(res), changes)
+		self.cacheLoaded = self.cacheMisses
+		multiprocessing.util.Finalize(None, self.saveCache, exitpriority=10)
+
+	def saveCache(self):
+		"""Writes the cache to disk, Links are stored as plain tuples"""
+		if self.cacheMisses == self.cacheLoaded:
+			return
+		entries = []
+		for (key, (result, changes)) in self.cache.items.items():
+			res = []
+			for node in result:
+				if isinstance(node, Link):
+					node = (unicode(node), node.uri, getattr(node, 'predicate', None))
+				res.append(node)
+			entries.append((key, res, changes))
+		cacheName = self.cacheName()
+		try:
+			Util.dumpPickle(entries, cacheName)
+			Util.removeCached('references-%s-*.pickle' % '-'.join(self.roots), keep=cacheName)
+		except (cPickle.PicklingError, TypeError):
+			pass
 
 	def loadEbnf(self, file):
 		"""Loads the syntax from a given EBNF file"""
@@ -125,15 +516,196 @@ class Reference:
 		f.close()
 		return [x.group(1) for x in re.finditer(r'(\w+(Ref|RefID))\s*::=', syntax)]
 
-	def getRelationship(self, predicate):
-		d = {}
-		for obj, subj in self.graph.subject_objects(predicate):
-			d[unicode(subj)] = unicode(obj)
-		return d
-
 	def parse(self, indata, baseUri='http://rinfo.lagrummet.se/publ/sfs/9999:999#K9P9S9P9',predicate=None):
 		if indata == '':
 			return indata
+		Benchmark.size('reference', len(indata))
+		if self.stats:
+			self.count('calls')
+		with Benchmark.phase('reference'):
+			if self.isPlain(indata):
+				self.fastPath += 1
+				if self.stats:
+					self.count('fastPath')
+				return [unicode(indata)]
+			if not self.cache.maxsize:
+				return self._parse(indata, baseUri, predicate)
+			return self._parseCached(unicode(indata), baseUri, predicate)
+
+	def parseMany(self, fragments, baseUris, predicate=None):
+		"""Parses a list of texts, each with its own baseUri. The result is 
+		the same as calling parse for each of them in order, but the texts 
+		are tagged together in one buffer"""
+		Benchmark.size('reference', sum([len(f) for f in fragments]))
+		if self.stats:
+			self.count('calls', len(fragments))
+			self.count('batches')
+		with Benchmark.phase('reference'):
+			# Plain texts aren't tagged. If an earlier fragment names a law
+			# they aren't plain when they're formatted, and are then tagged 
+			# one by one
+			todo = [i for (i, f) in enumerate(fragments)
+					if f != '' and not self.isPlain(f) and 
+					not self._isCached(f, baseUris[i], predicate)]
+			tagged = dict(zip(todo, self._tagMany([fragments[i] for i in todo])))
+
+			# The formatting depends on the earlier references, so it's done
+			# in order, like parse would have done it
+			results = []
+			for (i, text) in enumerate(fragments):
+				if text == '':
+					results.append(text)
+				elif self.isPlain(text):
+					self.fastPath += 1
+					if self.stats:
+						self.count('fastPath')
+					results.append([unicode(text)])
+				elif not self.cache.maxsize:
+					results.append(self._parse(text, baseUris[i], predicate, tagged.get(i)))
+				else:
+					results.append(self._parseCached(unicode(text), baseUris[i], predicate, tagged.get(i)))
+			return results
+
+	def isPlain(self, text):
+		"""True if parse would return the text as it is. A word with a law 
+		suffix is tagged as a NamedExternalLawRef, but it's only a link if 
+		the name is a known law"""
+		if self.reToken.search(text):
+			return False
+		if self.LAGRUM not in self.args:
+			return True
+		named = False
+		for m in self.reEscapeNamed.finditer(text):
+			# The '|' must follow a letter to be a part of the NamedLaw
+			if not self.reLawNameChar.match(text, m.start() - 1):
+				return False
+			named = True
+		if not named:
+			return not self.reEscapeCompound.search(text)
+		if '_' in text or self.reEscapeCompound.search(text):
+			return False
+		if self.namedLawIndex.search(text):
+			return False
+		lowered = text.lower()
+		for name in self.currentNamedLaws:
+			if name in lowered:
+				return False
+		return True
+
+	def _tagMany(self, texts):
+		"""Tags the texts in one buffer, returns the root nodes for each 
+		text. They are separated by a character that only the plain 
+		production accepts, so to the other productions it's like the end 
+		of the text. If the buffer can't be tagged to the end None is 
+		returned for every text, they're then tagged one by one"""
+		if not texts:
+			return []
+		escaped = [self._escape(t) for t in texts]
+		data = [d for (d, marks) in escaped]
+		buf = self.separator.join(data)
+		if self.stats:
+			started = time.time()
+		tagList = tag(buf, self.tagger, 0, len(buf))
+		if self.stats:
+			self.count('tagTime', time.time() - started)
+			self.count('bytesTagged', len(buf))
+		if tagList[-1] != len(buf):
+			if self.stats:
+				self.count('batchFailures')
+			return [None] * len(texts)
+
+		ends = []
+		end = -len(self.separator)
+		for d in data:
+			end += len(self.separator) + len(d)
+			ends.append(end)
+
+		if None in [marks for (d, marks) in escaped]:
+			tree = TagTree(tagList, buf)
+		else:
+			# The marks of each text moved to where it is in buf
+			marks = array('i')
+			start = 0
+			for (d, m) in escaped:
+				marks.extend([offset + start for offset in m])
+				start += len(d) + len(self.separator)
+			source = self.separator.join([unicode(t) for t in texts])
+			tree = TagTree(tagList, buf, source, marks)
+		if self.stats:
+			self.countProductions(tree)
+		res = [[] for t in texts]
+		i = 0
+		for n in tree.root().nodes:
+			(start, stop) = (n.start, n.end)
+			while start > ends[i]:
+				i += 1
+			if start == ends[i]:
+				# The separator
+				continue
+			if stop > ends[i]:
+				if self.stats:
+					self.count('batchFailures')
+				return [None] * len(texts)
+			res[i].append(n)
+		return res
+
+	def _isCached(self, text, baseUri, predicate):
+		"""True if the result for text is in the cache no matter what the 
+		earlier references in the document were"""
+		if not self.cache.maxsize:
+			return False
+		text = unicode(text)
+		return (not self.reSameLaw.search(text) and 
+				not self.reEscapeNamed.search(text) and
+				(text, baseUri, predicate) in self.cache)
+
+	def _parseCached(self, text, baseUri, predicate, nodes=None):
+		"""Returns the result from the cache, or parses text and stores it. 
+		A result depends on the earlier references in the document if the 
+		text refers to 'samma lag' or to a law by name, the state that is 
+		read is then a part of the key. A hit does the same changes to the 
+		state as parsing would have done"""
+		key = (text, baseUri, predicate)
+		sameLaw = self.reSameLaw.search(text)
+		if sameLaw:
+			key += (self.lastLaw,)
+		if self.currentNamedLaws and self.reEscapeNamed.search(text):
+			key += (tuple(sorted(self.currentNamedLaws.items())),)
+
+		entry = self.cache.get(key)
+		if entry is not None:
+			self.cacheHits += 1
+			if self.stats:
+				self.count('cacheHits')
+			(result, (lawSet, lastLaw, namedLaws)) = entry
+			if lawSet:
+				self.lastLaw = lastLaw
+			self.currentNamedLaws.update(namedLaws)
+			return list(result)
+
+		self.cacheMisses += 1
+		if self.stats:
+			self.count('cacheMisses')
+		lastLaw = self.lastLaw
+		namedLaws = self.currentNamedLaws.copy()
+		if not sameLaw:
+			# Not read, it's replaced to see if parse sets a law
+			self.lastLaw = _noLaw
+		try:
+			result = self._parse(text, baseUri, predicate, nodes)
+		finally:
+			lawSet = self.lastLaw is not _noLaw
+			if not lawSet:
+				self.lastLaw = lastLaw
+
+		changes = (lawSet, self.lastLaw if lawSet else None,
+				   tuple([(k, v) for (k, v) in self.currentNamedLaws.items()
+						  if namedLaws.get(k) != v]))
+		self.cache[key] = (tuple(result), changes)
+		return result
+
+	def _parse(self, indata, baseUri, predicate, nodes=None):
+		"""Parses indata, or formats the nodes that it's already tagged to"""
 		self.predicate = predicate
 		self.baseUri = baseUri
 		if baseUri:
@@ -150,20 +722,30 @@ class Reference:
 		else:
 			self.baseUriAttrs = {}
 
+		if nodes is None:
+			(fixedIndata, marks) = self._escape(indata)
+			if self.stats:
+				started = time.time()
+			tagList = tag(fixedIndata, self.tagger,0,len(fixedIndata))
+			if marks is None:
+				tree = TagTree(tagList, fixedIndata)
+			else:
+				tree = TagTree(tagList, fixedIndata, unicode(indata), marks)
+			if self.stats:
+				self.count('tagTime', time.time() - started)
+				self.count('bytesTagged', len(fixedIndata))
+				self.countProductions(tree)
+			nodes = tree.root().nodes
+		else:
+			tagList = None
 
-		fixedIndata = unicode(indata)
-		
-		if self.LAGRUM in self.args:
-			fixedIndata = self.reEscapeCompound.sub(r'\1_\2_\3\4', fixedIndata)
-			fixedIndata = self.reEscapeNamed.sub(r'|\1', fixedIndata)
-
-		if isinstance(fixedIndata, unicode):
-			fixedIndata = fixedIndata.encode(SP_CHARSET, 'xmlcharrefreplace')
+		if self.stats:
+			started = time.time()
+		# Sliced texts are already what the rewrite below would make them
+		sliced = bool(nodes) and nodes[0].tree.source is not None
 
-		tagList = tag(fixedIndata, self.tagger,0,len(fixedIndata))
 		res = []
-		root = NodeTree(tagList, fixedIndata)
-		for n in root.nodes:
+		for n in nodes:
 			if n.tag in self.roots:
 				self.clearState()
 				res.extend(self.formatterDispatch(n))
@@ -175,7 +757,9 @@ class Reference:
 				self.lastLaw = self.currentLaw
 			self.currentLaw = None
 
-		if tagList[-1] != len(fixedIndata):
+		if tagList is not None and tagList[-1] != len(fixedIndata):
+			if self.stats:
+				self.count('failures')
 			#TODO: Add Error 
 			raise ParseError, 'Parsed %s chars of %s (...%s...)' % (tagList[-1], len(indata), indata[(tagList[-1]-2):tagList[-1]+3])
 
@@ -183,7 +767,7 @@ class Reference:
 		result = []
 		
 		for i in range(len(res)):
-			if not self.reDescapeNamed.search(res[i]):
+			if sliced or not self.reDescapeNamed.search(res[i]):
 				node = res[i]
 			else:
 				if self.LAGRUM in self.args:
@@ -193,9 +777,9 @@ class Reference:
 					# A Link obj is immutable so we have to 
 					# create a new and copy its attrs
 					if hasattr(res[i], 'predicate'):
-						node = LinkSubject(text, predicate=res[i].predicate, uri=res[i].uri)
+						node = self.makeLink(text, res[i].uri, res[i].predicate)
 					else:
-						node = Link(text, uri=res[i].uri)
+						node = self.makeLink(text, res[i].uri)
 				else:
 					node = text
 			if (len(result) > 0 
@@ -206,34 +790,67 @@ class Reference:
 				result.append(node)
 
 		for i in range(len(result)):
-			if isinstance(result[i], Link):
+			if sliced or isinstance(result[i], Link):
 				pass
 			else:
 				result[i] = self.reXmlCharref.sub(self.unescapeXmlCharref, result[i])
 
+		if self.stats:
+			self.count('formatTime', time.time() - started)
 		return result
 
+	def count(self, name, n=1):
+		Stats.add('reference ' + self.statsName, name, n)
+
+	def countProductions(self, tree):
+		"""Counts the nodes of each production in a tagged text"""
+		for (name, ids) in tree.index.items():
+			Stats.add('productions ' + self.statsName, name, len(ids))
+
+	def _escape(self, indata):
+		"""Marks the named laws and encodes the text for the tagger. Returns
+		the text and the offsets after the marks, or None for the offsets 
+		if the results must be rewritten, see offsetMap"""
+		fixedIndata = unicode(indata)
+		marks = None
+		if self.offsetMap and not self.reRewrite.search(fixedIndata):
+			marks = array('i')
+
+		if self.LAGRUM in self.args:
+			# Only replaces spaces, the offsets are the same
+			fixedIndata = self.reEscapeCompound.sub(r'\1_\2_\3\4', fixedIndata)
+			if marks is None:
+				fixedIndata = self.reEscapeNamed.sub(r'|\1', fixedIndata)
+			else:
+				parts = []
+				pos = 0
+				for m in self.reEscapeNamed.finditer(fixedIndata):
+					parts.append(fixedIndata[pos:m.start()])
+					parts.append(u'|')
+					pos = m.start()
+					marks.append(pos + len(marks) + 1)
+				parts.append(fixedIndata[pos:])
+				fixedIndata = u''.join(parts)
+
+		if isinstance(fixedIndata, unicode):
+			fixedIndata = fixedIndata.encode(SP_CHARSET, 'xmlcharrefreplace')
+		return (fixedIndata, marks)
+
 	def unescapeXmlCharref(self, m):
 		return unichr(int(m.group(0)[2:-1]))
 
 	def findAttrs(self, parts, extra={}):
-		"""Creates a dict of attributes through a tree"""
+		"""Creates a dict of attributes through a tree, the last ...RefID 
+		node in preorder gives the value for an attribute"""
 		d = {}
-		self.depth += 1
 		if extra:
 			d.update(extra)
 		for part in parts:
-			currentPartTag = part.tag.lower()
-			if currentPartTag.endswith('refid'):
-				if ((currentPartTag == 'singelsectionrefid') or 
-					(currentPartTag == 'lastsectionrefid')):
-					currentPartTag = 'sectionrefid'
-				d[currentPartTag[:-5]] = part.text.strip()
-
-			if part.nodes:
-				d.update(self.findAttrs(part.nodes, d))
-
-		self.depth -= 1
+			tree = part.tree
+			for i in part.descendants():
+				key = self.attrKey(tree.tagNames[tree.tag[i]])
+				if key:
+					d[key] = tree.data[tree.start[i]:tree.end[i]].decode(SP_CHARSET).strip()
 
 		if self.currentLaw and 'law' not in d:
 			d['law'] = self.currentLaw
@@ -246,31 +863,32 @@ class Reference:
 
 		return d
 
+	def attrKey(self, tagName):
+		"""The attribute that a ...RefID tag gives a value for, or None"""
+		if tagName not in self._attrKeys:
+			key = tagName.lower()
+			if key.endswith('refid'):
+				if key in ('singelsectionrefid', 'lastsectionrefid'):
+					key = 'sectionrefid'
+				self._attrKeys[tagName] = key[:-5]
+			else:
+				self._attrKeys[tagName] = None
+		return self._attrKeys[tagName]
+
 	def findNode(self, root, nodeTag):
 		"""Returns the first node in the tree that has a matching tag, dfs."""
-		if root.tag == nodeTag:
-			return root
-		else:
-			for node in root.nodes:
-				x = self.findNode(node, nodeTag)
-				if x != None:
-					return x
-			return None
+		return root.tree.find(root.id, nodeTag)
 
 	def findNodes(self, root, nodeTag):
-		if root.tag == nodeTag:
-			return [root]
-		else:
-			res = []
-			for node in root.nodes:
-				res.extend(self.findNodes(node, nodeTag))
-			return res
+		return root.tree.findAll(root.id, nodeTag)
 
 	def formatterDispatch(self, part):
 		self.depth += 1
-		if 'format_' + part.tag in dir(self):
-			formatter = getattr(self,'format_'+part.tag)
-			res = formatter(part)
+		formatter = self.formatters.get(part.tag)
+		if formatter:
+			if self.stats:
+				Stats.add('formatters ' + self.statsName, part.tag)
+			res = formatter(self, part)
 			assert res != None, 'Custom formatter for %s didnt return anythin' % part.tag
 		else:
 			res = self.formatTokentree(part)
@@ -296,22 +914,27 @@ class Reference:
 		try:
 			uri = self.uriFormatter[part.tag](self.findAttrs([part]))			
 		except KeyError:
+			# No URI formatter for the production
+			if self.stats:
+				Stats.add('fallbacks ' + self.statsName, part.tag)
 			if uriFormatter:
 				uri = uriFormatter(self.findAttrs([part]))	
 			else:
 				uri = self.sfsFormatUri(self.findAttrs([part]))
 		except AttributeError:
+			if self.stats:
+				Stats.add('fallbacks ' + self.statsName, part.tag + ' (error)')
 			return part.text
 		except:
 			exc = sys.exc_info()
+			if self.stats:
+				Stats.add('fallbacks ' + self.statsName, part.tag + ' (error)')
 			return part.text
 
 		if not uri:
 			return part.text
-		elif self.predicate:
-			return LinkSubject(part.text, uri=uri, predicate=self.predicate)
 		else:
-			return Link(part.text, uri=uri)
+			return self.makeLink(part.text, uri, self.predicate)
 
 	def formatCustomLink(self, attrs, text, production):
 		try:
@@ -321,10 +944,21 @@ class Reference:
 
 		if not uri:
 			return part.text
-		elif self.predicate:
-			return LinkSubject(text, uri=uri, predicate=self.predicate)
 		else:
-			return Link(text, uri=uri)
+			return self.makeLink(text, uri, self.predicate)
+
+	def makeLink(self, text, uri, predicate=None):
+		"""Returns a LinkSubject, or a Link if there's no predicate. Links 
+		are immutable, so equal links in a document are the same object"""
+		key = (text, uri, predicate)
+		link = self.links.get(key)
+		if link is None:
+			if predicate:
+				link = LinkSubject(text, uri=uri, predicate=predicate)
+			else:
+				link = Link(text, uri=uri)
+			self.links[key] = link
+		return link
 
 	def clearState(self):
 		self.currentLaw 	= None
@@ -332,6 +966,18 @@ class Reference:
 		self.currentSection	= None
 		self.currentPiece	= None
 
+	def reset(self):
+		"""Forget everything learned from the previous document, call this 
+		before parsing references in a new document"""
+		self.clearState()
+		self.depth				= 0
+		self.lastLaw			= None
+		self.currentNamedLaws	= {}
+		# Built URIs and Links are shared within a document
+		self.uris				= {}
+		self.internedUris		= {}
+		self.links				= {}
+
 	def normalizeSfsId(self, sfsId):
 		sfsId = re.sub(r'(\d+:\d+)\.(\d)', r'\1 \2', sfsId)
 		return sfsId
@@ -346,102 +992,7 @@ class Reference:
 		if normalize:
 			text = self.normalizeLawName(text)
 
-		noLaw = [
-			u'aktieslagen',
-			u'anordningen',
-			u'anordningen',
-			u'anslagen',
-			u'arbetsordningen',
-			u'associationsformen',
-			u'avfallsslagen',
-			u'avslagen',
-			u'avvittringsutslagen',
-			u'bergslagen',
-			u'beskattningsunderlagen',
-			u'bolagen',
-			u'bolagsordningen',
-			u'bolagsordningen',
-			u'dagordningen',
-			u'djurslagen',
-			u'dotterbolagen',
-			u'emballagen',
-			u'energislagen',
-			u'ersttningsformen',
-			u'ersttningsslagen',
-			u'examensordningen',
-			u'finansbolagen',
-			u'finansieringsformen',
-			u'fissionsvederlagen',
-			u'flygbolagen',
-			u'fondbolagen',
-			u'frbundsordningen',
-			u'freslagen',
-			u'fretrdesordningen',
-			u'frhandlingsordningen',
-			u'frlagen',
-			u'frmnsrttsordningen',
-			u'frmgenhetsordningen',
-			u'frordningen',
-			u'frslagen',
-			u'frskringsaktiebolagen',
-			u'frskringsbolagen',
-			u'gravanordningen',
-			u'grundlagen',
-			u'handelsplattformen',
-			u'handlggningsordningen',
-			u'inkomstslagen',
-			u'inkpssamordningen',
-			u'kapitalunderlagen',
-			u'klockslagen',
-			u'kopplingsanordningen',
-			u'lneformen',
-			u'mervrdesskatteordningen',
-			u'nummerordningen',
-			u'omslagen',
-			u'ordalagen',
-			u'pensionsordningen',
-			u'renhllningsordningen',
-			u'representationsreformen',
-			u'rttegngordningen',
-			u'rttegngsordningen',
-			u'rttsordningen',
-			u'samordningen',
-			u'samordningen',
-			u'skatteordningen',
-			u'skatteslagen',
-			u'skatteunderlagen',
-			u'skolformen',
-			u'skyddsanordningen',
-			u'slagen',
-			u'solvrmeanordningen',
-			u'storslagen',
-			u'studieformen',
-			u'stdformen',
-			u'stdordningen',
-			u'stdordningen',
-			u'skerhetsanordningen',
-			u'talarordningen',
-			u'tillslagen',
-			u'tivolianordningen',
-			u'trafikslagen',
-			u'transportanordningen',
-			u'transportslagen',
-			u'trdslagen',
-			u'turordningen',
-			u'underlagen',
-			u'uniformen',
-			u'uppstllningsformen',
-			u'utvecklingsbolagen',
-			u'varuslagen',
-			u'verksamhetsformen',
-			u'vevanordningen',
-			u'vrdformen',
-			u'goanordningen',
-			u'goslagen',
-			u'rendeslagen',
-			u'tgrdsfrslagen']
-			
-		if text in noLaw:
+		if text in self.noLaw:
 			return None
 		if self.currentNamedLaws.has_key(text):
 			return self.currentNamedLaws[text]
@@ -451,43 +1002,34 @@ class Reference:
 			return None
 
 	def sfsFormatUri(self, attrs):
-		pieceMap = {u'frsta'	:'1',
-				  u'andra'	:'2',
-				  u'tredje'	:'3',
-				  u'fjrde'	:'4',
-				  u'femte'	:'5',
-				  u'sjtte'	:'6',
-				  u'sjunde'	:'7',
-				  u'ttonde':'8',
-				  u'nionde'	:'9'}
-		
-		keyMap = {u'lawref'	:'L',
-				  u'chapter':'K',
-				  u'section':'P',
-				  u'piece'	:'S',
-				  u'item'	:'N',
-				  u'itemnumeric': 'N',
-				  u'element':'O',
-				  u'sentence': 'M'}
-		
-		attrOrder = ['law', 'lawref', 'chapter', 'section', 'element', 'piece', 'item', 'itemnumeric', 'sentence']
-
+		"""Returns the URI for the attributes, it's only built once for the
+		same attributes and base URI in a document"""
+		key = (tuple(sorted(attrs.items())), tuple(sorted(self.baseUriAttrs.items())))
+		uri = self.uris.get(key)
+		if uri is None:
+			uri = self._sfsFormatUri(attrs)
+			# Links to the same target shares the string
+			uri = self.internedUris.setdefault(uri, uri)
+			self.uris[key] = uri
+		return uri
+
+	def _sfsFormatUri(self, attrs):
 		if 'law' in attrs:
 			if attrs['law'].startswith('http://'):
-				res = ''
+				res = ['']
 			else:
-				res = 'http://rinfo.lagrummet.se/publ/sfs/'
+				res = ['http://rinfo.lagrummet.se/publ/sfs/']
 		else:
 			if 'baseUri' in self.baseUriAttrs:
-				res = self.baseUriAttrs['baseUri']
+				res = [self.baseUriAttrs['baseUri']]
 			else:
-				res = ''
+				res = ['']
 
 		resolveBase = True
 		addFragment = False
 		justInCase 	= None
 
-		for key in attrOrder:
+		for key in self.attrOrder:
 			if attrs.has_key(key):
 				resolveBase = False
 				val = attrs[key]
@@ -498,28 +1040,30 @@ class Reference:
 
 			if val:
 				if addFragment:
-					res += '#'
+					res.append('#')
 					addFragment = False
-				if (key in ['piece', 'itemnumeric', 'sentence'] and val in pieceMap):
-					res += '%s%s' % (keyMap[key], pieceMap[val.lower()])
+				if (key in ['piece', 'itemnumeric', 'sentence'] and val in self.pieceMap):
+					res.append(self.keyMap[key])
+					res.append(self.pieceMap[val.lower()])
 				else:
 					if key == 'law':
 						val = self.normalizeSfsId(val)
 						val = val.replace(' ', '_')
-						res += val
+						res.append(val)
 						addFragment = True
 					else:
 						if justInCase:
-							res += justInCase
+							res.append(justInCase)
 							justInCase = None
 						val = val.replace(' ', '')
 						val = val.replace('\n', '')
 						val = val.replace('\r', '')
-						res += '%s%s' % (keyMap[key], val)
+						res.append(self.keyMap[key])
+						res.append(val)
 			else:
 				if key == 'piece':
 					justInCase = 'S1'
-		return res								
+		return ''.join(res)
 
 	def format_SFSNr(self, root):
 		if self.baseUri == None:
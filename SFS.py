@@ -13,9 +13,10 @@ import htmlentitydefs
 from tempfile import mktemp
 from datetime import date, datetime
 from collections import defaultdict
+from array import array
+from bisect import bisect_left
 
 #3rd party libs
-from rdflib import Graph
 from rdflib import Namespace, RDFS, RDF, URIRef, Literal
 
 #Own libs
@@ -23,6 +24,9 @@ import Source
 import config
 from Reference import Reference, Link, LinkSubject, ParseError
 import Util
+import KnowledgeBase
+import Manifest
+import Benchmark
 from Dispatcher import Dispatcher
 from DataObjects import CompoundStructure, MapStructure, \
 	 UnicodeStructure, PredicateType, DateStructure, \
@@ -146,6 +150,196 @@ class RevokedDoc(Exception):
 	"""Thrown when a doc that is revoked is being parsed"""
 	pass
 
+class LineTokens(object):
+	"""The lines of a SFST text, with what each line could start and its 
+	ordinal. The lines are found in one pass before the text is parsed, 
+	and a line is lexed the first time it's asked for, so the line 
+	predicates of SFSParser never have to match a line again"""
+	BLANK					= 1
+	AVDELNING				= 2
+	UPPHAVT_KAPITEL			= 4
+	UPPHAVD_PARAGRAF		= 8
+	OVERGANGSBESTAMMELSE	= 16
+	BILAGA					= 32
+	NUMRERAD_LISTA			= 64
+	STRECKSATS_LISTA		= 128
+	BOKSTAVS_LISTA			= 256
+
+	UNKNOWN					= -1
+	FAILED					= -2
+
+	def __init__(self, data, linesep, start, lexLine):
+		self.data = data
+		self.lexLine = lexLine
+		self.offsets = array('i')
+		self.ends = array('i')
+		pos = start
+		while pos < len(data):
+			end = data.find(linesep, pos)
+			if end == -1:
+				end = len(data)
+			self.offsets.append(pos)
+			self.ends.append(end)
+			pos = end + len(linesep)
+		self.kinds = array('i', [self.UNKNOWN]) * len(self.offsets)
+		# Ordinals by line and kind
+		self.ordinals = {}
+
+	def find(self, offset):
+		"""The line that starts at offset, None if there's no such line or
+		if it couldn't be lexed"""
+		i = bisect_left(self.offsets, offset)
+		if i == len(self.offsets) or self.offsets[i] != offset:
+			return None
+		if self.kinds[i] == self.UNKNOWN:
+			self._lex(i)
+		if self.kinds[i] == self.FAILED:
+			return None
+		return i
+
+	def _lex(self, i):
+		# As peekLine returns it
+		l = self.data[self.offsets[i]:self.ends[i]].strip().expandtabs(8)
+		try:
+			(kind, ordinals) = self.lexLine(l)
+		except Exception:
+			# Left to the predicates, so it fails when it's peeked
+			self.kinds[i] = self.FAILED
+			return
+		self.kinds[i] = kind
+		for (k, ordinal) in ordinals.items():
+			self.ordinals[(i, k)] = ordinal
+
+	def has(self, i, kind):
+		return bool(self.kinds[i] & kind)
+
+	def ordinal(self, i, kind):
+		return self.ordinals.get((i, kind))
+
+# Marks that a result isn't in the ParagraphWindow
+_missing = object()
+
+class ParagraphWindow(object):
+	"""The next paragraphs from the position of a reader and the results 
+	of the predicates for them. A paragraph is peeked once, even if it's
+	peeked again from an earlier position, and a predicate is only tested 
+	once for the same paragraph and state, even if it's asked for by 
+	several predicates or make methods"""
+	def __init__(self, reader, size=256):
+		self.reader = reader
+		self.size = size
+		# The paragraph at an offset and the offset of the next one, by 
+		# the offset and if the reader strips
+		self.paragraphs = {}
+		self.results = {}
+
+	def position(self):
+		"""The reader position, peeks also depends on if it strips"""
+		return (self.reader.currPos, self.reader.autostrip)
+
+	def peek(self, times=1):
+		"""The same as peekParagraph of the reader"""
+		autostrip = self.reader.autostrip
+		pos = self.reader.currPos
+		for i in range(times):
+			res = self.paragraphs.get((pos, autostrip))
+			if res is None:
+				try:
+					res = self.reader.peekChunkAt(self.reader.linesep * 2, pos)
+				except IOError, e:
+					res = e
+				# The paragraphs before the reader aren't needed again
+				if len(self.paragraphs) >= self.size:
+					self.paragraphs.clear()
+				self.paragraphs[(pos, autostrip)] = res
+			if isinstance(res, IOError):
+				raise res
+			(p, pos) = res
+		return p
+
+	def read(self):
+		"""The same as readParagraph of the reader, but the paragraph is 
+		taken from the peeked ones"""
+		try:
+			p = self.peek()
+		except IOError:
+			return self.reader.readParagraph()
+		self.reader.currPos = self.paragraphs[self.position()][1]
+		return p
+
+	def get(self, key, default=None):
+		return self.results.get(key, default)
+
+	def set(self, key, value):
+		# The results that are kept are the ones for the paragraphs 
+		# just read and the next few, so start over when it's full
+		if len(self.results) >= self.size:
+			self.results.clear()
+		self.results[key] = value
+
+	def cached(self, key, func, *args):
+		res = self.results.get(key, _missing)
+		if res is _missing:
+			res = func(*args)
+			self.set(key, res)
+		return res
+
+class HeadingMatcher(object):
+	"""Finds the heading that a line is close to, the same as 
+	difflib.get_close_matches(line, headings, 1, cutoff) but without the 
+	SequenceMatcher for most lines. A line is first rejected by its length
+	and by the chars that it or the heading doesn't have, these bound the
+	ratio of the heading from above"""
+	def __init__(self, headings, cutoff=0.9, size=4096):
+		self.cutoff = cutoff
+		self.size = size
+		self.headings = [(h, len(h), frozenset(h)) for h in headings]
+		self.maxLength = 0
+		for (h, la, chars) in self.headings:
+			# The longest line with a real_quick_ratio within the cutoff
+			lb = la
+			while self._ratio(la, la + lb + 1) >= cutoff:
+				lb += 1
+			self.maxLength = max(self.maxLength, lb)
+		self.matches = {}
+
+	def _ratio(self, matches, length):
+		# As difflib computes it
+		if length:
+			return 2.0 * matches / length
+		return 1.0
+
+	def match(self, line):
+		"""The closest heading, None if no heading is close enough"""
+		if len(line) > self.maxLength:
+			return None
+		res = self.matches.get(line, _missing)
+		if res is _missing:
+			res = self._match(line)
+			if len(self.matches) >= self.size:
+				self.matches.clear()
+			self.matches[line] = res
+		return res
+
+	def _match(self, line):
+		lb = len(line)
+		chars = frozenset(line)
+		candidates = []
+		for (h, la, hchars) in self.headings:
+			if h == line:
+				return h
+			# Each char that only one of them has is a char of it that 
+			# isn't in any matching block
+			matches = min(la - len(hchars - chars), lb - len(chars - hchars))
+			if self._ratio(matches, la + lb) >= self.cutoff:
+				candidates.append(h)
+		if not candidates:
+			return None
+		fuzz = difflib.get_close_matches(line, candidates, 1, self.cutoff)
+		if fuzz:
+			return fuzz[0]
+		return None
+
 class NotSFS(Exception):
 	"""Thrown when not a real SFS document is being parsed as a SFS document"""
 	pass
@@ -172,11 +366,16 @@ class SFSParser(Source.Parser):
 	reBokstavsLista		= re.compile(r'^(\w)\) ')
 	reNumberRightPara	= re.compile(r'^(\d+)\) ').match
 	reBullet			= re.compile(ur'^(\-\-?|\x96) ')
+	# Two or more spaces before a char, between the cells of a table row
+	reTableGutter		= re.compile(r'  +(?=[^ ])').finditer
 
-	reRevokeDate 		= re.compile(ur'/(?:Rubriken u|U)pphr att glla U:(\d+)-(\d+)-(\d+)/') 
-	reRevokeAuth		= re.compile(ur'/Upphr att glla U:(den dag regeringen bestmmer)/')
-	reEntryIntoForceDate = re.compile(ur'/(?:Rubriken t|T)rder i kraft I:(\d+)-(\d+)-(\d+)/')
-	reEntryIntoForceAuth = re.compile(ur'/Trder i kraft I:(den dag regeringen bestmmer)/')
+	# The revoke and entry into force markers, with a date or the 
+	# authority that decides it. The name of the group is the key
+	reAndringsDatum		= re.compile(ur'/(?:'
+		ur'(?:Rubriken u|U)pphr att glla U:(?P<upphor>\d+-\d+-\d+)|'
+		ur'Upphr att glla U:(?P<upphorAuth>den dag regeringen bestmmer)|'
+		ur'(?:Rubriken t|T)rder i kraft I:(?P<ikrafttrader>\d+-\d+-\d+)|'
+		ur'Trder i kraft I:(?P<ikrafttraderAuth>den dag regeringen bestmmer))/')
 
 	reDefinitions 		= re.compile(r'^I (lagen|frordningen|balken|denna lag|denna frordning|denna balk|denna paragraf|detta kapitel) (avses med|betyder|anvnds fljande)').match
 	reBrottsDef 		= re.compile(ur'\b(dms|dmes)(?: han)?(?:,[\w ]+,)? fr ([\w ]{3,50}) till (bter|fngelse)', re.UNICODE).search
@@ -207,15 +406,32 @@ class SFSParser(Source.Parser):
 
 	sweOrdDict = dict(zip(sweOrdMap, range(1, len(sweOrdMap) + 1 )))
 
+	overgangsRubriker = (u'vergngsbestmmelser',
+						 u'Ikrafttrdande- och vergngsbestmmelser',
+						 u'vergngs- och ikrafttrdandebestmmelser')
+	overgangsMatcher = HeadingMatcher(overgangsRubriker)
+
 	def __init__(self):
 		self.lagrumParser = Reference(Reference.LAGRUM)
 		self.forarbeteParser = Reference(Reference.FORARBETEN)
 
+		Source.Parser.__init__(self)
+		self.reset()
+
+	def reset(self):
 		self.currentSection = u'0'
 		self.currentHeadlineLevel = 0
-		Source.Parser.__init__(self)
+		self.reader = None
+		self.lines = None
+		self.window = None
+		# The parsed dates of the change markers, by their text
+		self.datumCache = {}
+		self.registry = None
+		self.lagrumParser.reset()
+		self.forarbeteParser.reset()
 
 	def Parse(self, f, files):
+		self.reset()
 		self.id = f 
 		timestamp = sys.maxint
 		for filelist in files.values():
@@ -224,11 +440,15 @@ class SFSParser(Source.Parser):
 					timestamp = os.path.getmtime(file)
 		
 		# Parse SFSR file
-		registry = self._parseSFSR(files['sfsr'])
+		Benchmark.size('sfsr', sum([os.path.getsize(x) for x in files['sfsr']]))
+		with Benchmark.phase('sfsr'):
+			registry = self._parseSFSR(files['sfsr'])
 		
 		# Extract the plaintext and create a intermediate file for storage
 		try:
-			plaintext = self._extractSFST(files['sfst'])
+			with Benchmark.phase('sfst'):
+				plaintext = self._extractSFST(files['sfst'])
+			Benchmark.size('sfst', len(plaintext))
 			txtFile = files['sfst'][0].replace('.html', '.txt').replace('dl/sfst', 'intermediate')
 			Util.checkDir(txtFile)
 			tmpFile = mktemp()
@@ -279,12 +499,9 @@ class SFSParser(Source.Parser):
 		meta[u'Senast hmtad'] = DateSubject(datetime.fromtimestamp(timestamp), predicate='rinfoex:senastHamtad')
 
 		# Fetch abbreviation if existing
-		g = Graph()
-		g.load(__scripDir__+'/etc/sfs-extra.n3', format='n3')
-
-		for obj in g.objects(URIRef(meta[u'xml:base']), DCT['alternate']):
-			meta[u'Frkortning'] = unicode(obj)
-			# print meta[u'Frkortning']
+		abbreviation = KnowledgeBase.load().table('alternate').get(meta[u'xml:base'])
+		if abbreviation:
+			meta[u'Frkortning'] = abbreviation
 		
 		obs = None
 		for p in body:
@@ -477,7 +694,15 @@ class SFSParser(Source.Parser):
 	# 	1. Finds definitions for terms in the text
 	# 	2. Finds linkable objects that have their own URIs (kapitel, paragrafer, etc..)
 	# 	3. Finds 'lagrumshnvisningar' in the text
-	def _constructIds(self, element, prefix, baseUri, skipFrags=[], findDefs=False):
+	def _constructIds(self, element, prefix, baseUri, skipFrags=[], findDefs=False, pending=None):
+		if pending is None:
+			# The texts are collected from the whole tree and their references
+			# are parsed in one batch, then spliced into the elements
+			pending = []
+			self._constructIds(element, prefix, baseUri, skipFrags, findDefs, pending)
+			self._parseReferences(pending)
+			return
+
 		findDefsRecursive = findDefs
 		counters = defaultdict(int)
 		if isinstance(element, CompoundStructure):
@@ -499,7 +724,6 @@ class SFSParser(Source.Parser):
 			if (isinstance(element, Stycke) or
 				isinstance(element, Listelement) or
 				isinstance(element, TabellCell)):
-				nodes = []
 				term = None
 
 				if findDefs:
@@ -562,23 +786,14 @@ class SFSParser(Source.Parser):
 					else:
 						term = None
 
+				texts = []
 				for p in element:
 					if isinstance(p, unicode):
 						s = ' '.join(p.split())
 						s = s.replace(u'\x96', '-')
-						# Make all links have a dct:references
-						# predicate, needed to get useful RDF triples
-						
-						parsedNodes = self.lagrumParser.parse(s, baseUri+prefix, 'dct:references')
-
-						for n in parsedNodes:
-							if term and isinstance(n, unicode) and term in n:
-								(head, tail) = n.split(term, 1)
-								nodes.extend((head,termNode,tail))
-							else:
-								nodes.append(n)
+						texts.append(s)
 						idx = element.index(p)
-				element[idx:idx+1] = nodes
+				pending.append((element, idx, term, term and termNode, texts, baseUri+prefix))
 
 			# Construct the IDs
 			for p in element:
@@ -598,14 +813,38 @@ class SFSParser(Source.Parser):
 
 				if ((hasattr(p, 'fragLabel') and
 					 p.fragLabel in skipFrags)):
-					self._constructIds(p, prefix, baseUri, skipFrags,findDefsRecursive)
+					self._constructIds(p, prefix, baseUri, skipFrags,findDefsRecursive, pending)
 				else:
-					self._constructIds(p, fragment, baseUri, skipFrags, findDefsRecursive)
+					self._constructIds(p, fragment, baseUri, skipFrags, findDefsRecursive, pending)
 
 				# After the first row in a table is checked, skip row 2,3,.. 
 				if isinstance(element, TabellRad):
 					findDefsRecursive = False
 
+	def _parseReferences(self, pending):
+		"""Replaces the texts collected by _constructIds with the parsed 
+		references and defined terms"""
+		fragments = []
+		baseUris = []
+		for (element, idx, term, termNode, texts, uri) in pending:
+			fragments.extend(texts)
+			baseUris.extend([uri] * len(texts))
+
+		# Make all links have a dct:references
+		# predicate, needed to get useful RDF triples
+		results = iter(self.lagrumParser.parseMany(fragments, baseUris, 'dct:references'))
+
+		for (element, idx, term, termNode, texts, uri) in pending:
+			nodes = []
+			for s in texts:
+				for n in results.next():
+					if term and isinstance(n, unicode) and term in n:
+						(head, tail) = n.split(term, 1)
+						nodes.extend((head,termNode,tail))
+					else:
+						nodes.append(n)
+			element[idx:idx+1] = nodes
+
 	def _countElements(self, element):
 		counters = defaultdict(int)
 		if isinstance(element, CompoundStructure):
@@ -639,9 +878,14 @@ class SFSParser(Source.Parser):
 	def _parseSFST(self, txtFile, registry):
 		self.reader = TextReader(txtFile, encoding='iso-8859-1', linesep=TextReader.DOS)
 		self.reader.autostrip = True
+		self.window = ParagraphWindow(self.reader)
 		self.registry = registry
-		meta = self.makeHeader()
-		body = self.makeForfattning()
+		with Benchmark.phase('header'):
+			meta = self.makeHeader()
+		with Benchmark.phase('lexer'):
+			self.lines = self._lexLines()
+		with Benchmark.phase('forfattning'):
+			body = self.makeForfattning()
 		elements = self._countElements(body)
 		
 		if 'K' in elements and elements['P1'] < 2:
@@ -649,7 +893,8 @@ class SFSParser(Source.Parser):
 		else:
 			skipFrags = ['A']
 
-		self._constructIds(body, u'', u'http://rinfo.lagrummet.se/publ/sfs/%s#' % (FilenameToSfsNr(self.id)), skipFrags)
+		with Benchmark.phase('constructIds'):
+			self._constructIds(body, u'', u'http://rinfo.lagrummet.se/publ/sfs/%s#' % (FilenameToSfsNr(self.id)), skipFrags)
 
 		return meta,body
 
@@ -723,6 +968,44 @@ class SFSParser(Source.Parser):
 			
 		return meta
 
+	def _lexLines(self):
+		"""The lines from the reader position, they're lexed by _lexLine 
+		the same way as the line predicates do when they peek the line"""
+		return LineTokens(self.reader.data, self.reader.linesep, 
+						  self.reader.currPos, self._lexLine)
+
+	def _lexLine(self, l):
+		if l == '':
+			return (LineTokens.BLANK, {})
+		kind = 0
+		ordinals = {}
+		for (k, ordinal) in ((LineTokens.AVDELNING, self.idOfAvdelning(l)),
+							 (LineTokens.NUMRERAD_LISTA, self.idOfNumreradLista(l)),
+							 (LineTokens.BOKSTAVS_LISTA, self.idOfBokstavsLista(l))):
+			if ordinal != None:
+				kind |= k
+				ordinals[k] = ordinal
+		if self.isUpphavtKapitel(l):
+			kind |= LineTokens.UPPHAVT_KAPITEL
+		if self.isUpphavdParagraf(l):
+			kind |= LineTokens.UPPHAVD_PARAGRAF
+		if self.isOvergangsbestammelse(l):
+			kind |= LineTokens.OVERGANGSBESTAMMELSE
+		if u'Bilaga' in l and self.isBilaga(l):
+			kind |= LineTokens.BILAGA
+		if self.isStrecksatsLista(l):
+			kind |= LineTokens.STRECKSATS_LISTA
+		return (kind, ordinals)
+
+	def _lineToken(self):
+		"""The line at the reader position in self.lines, None if it's not 
+		the start of a lexed line or if the reader doesn't strip the lines 
+		like the lexer did"""
+		if (self.lines is None or not self.reader.autostrip or
+			self.reader.data is not self.lines.data):
+			return None
+		return self.lines.find(self.reader.currPos)
+
 	def makeForfattning(self):
 		while self.reader.peekLine() == '':
 			self.reader.readLine()
@@ -1056,7 +1339,7 @@ class SFSParser(Source.Parser):
 					pCount += 1
 				elif pCount == 0:
 					currIkrafttrader = None
-				p = self.reader.readParagraph()
+				p = self.window.read()
 				if p:
 					(trs, tabstops) = self.makeTabellRad(p, tabstops,kwargs=kwargs)
 					t.extend(trs)
@@ -1073,7 +1356,9 @@ class SFSParser(Source.Parser):
 				text = self.reDehypenate('', text)
 			return TabellCell([Util.normalizedSpace(text)])
 
-		cols = [u'', u'',u'', u'',u'', u'',u'', u'']
+		# The text of each cell is a list of its lines, joined when the 
+		# row is done
+		cols = [[] for i in range(8)]
 		if tabstops:
 			staticTabstops = True
 		else:
@@ -1094,45 +1379,39 @@ class SFSParser(Source.Parser):
 			if l == '':
 				continue
 			lineCount += 1
-			charCount = 0
-			spaceCount =0
 			lastTab = 0
 			colCount = 0
 			if singleLine:
-				cols = [u'', u'',u'', u'',u'', u'',u'', u'']
+				cols = [[] for i in range(8)]
 			if l[0] == ' ':
 				emptyLeft = True
 			else:
 				if emptyLeft:
 					rows.append(cols)
-					cols = [u'', u'',u'', u'',u'', u'',u'', u'']
+					cols = [[] for i in range(8)]
 					emptyLeft = False
 
-			for c in l:
-				charCount += 1
-				if c == u' ':
-					spaceCount += 1
-				else:
-					if spaceCount > 1:
-						# We have found a new table cell
-						cols[colCount] += u'\n' + l[lastTab:charCount-(spaceCount+1)]
-						lastTab = charCount -1
-
-						# Handle empty left cells
-						if lineCount > 1 or staticTabstops:
-							if tabstops[colCount+1] + 7 < charCount:
-								if len(tabstops) <= colCount + 2:
-									tabstops.append(0)
-									cols.append(u'')
-								if tabstops[colCount+2] != 0:
-									colCount += 1
-						colCount += 1
-						if len(tabstops) <= charCount:
+			for m in self.reTableGutter(l):
+				# We have found a new table cell, charCount is the 
+				# position of its first char counted from 1
+				charCount = m.end() + 1
+				cols[colCount].append(l[lastTab:m.start()])
+				lastTab = m.end()
+
+				# Handle empty left cells
+				if lineCount > 1 or staticTabstops:
+					if tabstops[colCount+1] + 7 < charCount:
+						if len(tabstops) <= colCount + 2:
 							tabstops.append(0)
-							cols.append(u'')
-						tabstops[colCount] = charCount
-					spaceCount = 0
-			cols[colCount] += u'\n' + l[lastTab:charCount]
+							cols.append([])
+						if tabstops[colCount+2] != 0:
+							colCount += 1
+				colCount += 1
+				if len(tabstops) <= charCount:
+					tabstops.append(0)
+					cols.append([])
+				tabstops[colCount] = charCount
+			cols[colCount].append(l[lastTab:])
 			if singleLine:
 				rows.append(cols)	
 
@@ -1144,6 +1423,7 @@ class SFSParser(Source.Parser):
 			tr = TabellRad(**kwargs)
 			emptyOk = True
 			for c in r:
+				c = u''.join([u'\n' + x for x in c])
 				if c or emptyOk:
 					tr.append(makeTabellCell(c.replace('\n', ' ')))
 					if c.strip() != u'':
@@ -1161,31 +1441,82 @@ class SFSParser(Source.Parser):
 		return None	
 
 	def andringsDatum(self, line, match=False):
+		"""Returns the line without its revoke and entry into force 
+		markers, and the revoke and entry into force dates. If there are
+		two markers for a date the first one is used. With match only the 
+		run of markers that the line begins with is read and removed, the
+		same marker later in the line is left in it. This is narrower than
+		before, when every occurrence of a marker that the line began with
+		was removed, and which of them were found depended on the order 
+		of a dict. makeTabell, the caller with match, only uses the dates"""
+		if u'/' not in line:
+			return (line.strip(), None, None)
 		dates = {'ikrafttrader'	: None,
 				 'upphor'		: None }
-
-		for (regex, key) in { self.reRevokeDate			: 'upphor',
-							  self.reRevokeAuth			: 'upphor',
-							  self.reEntryIntoForceDate : 'ikrafttrader',
-							  self.reEntryIntoForceAuth	: 'ikrafttrader'}.items():
-			if match:
-				m = regex.match(line)
+		pieces = []
+		pos = 0
+		if match:
+			markers = self._leadingMarkers(line)
+		else:
+			markers = self.reAndringsDatum.finditer(line)
+		for m in markers:
+			pieces.append(line[pos:m.start()])
+			pos = m.end()
+			key = m.lastgroup
+			value = m.group(key)
+			if key.endswith('Auth'):
+				key = key[:-4]
 			else:
-				m = regex.search(line)
-			if m:
-				if len(m.groups()) == 3:
-					dates[key] = datetime(int(m.group(1)),
-										  int(m.group(2)),
-										  int(m.group(3)))
-				else:
-					dates[key] = m.group(1)
-				line = regex.sub(u'', line)
+				value = self._datum(value)
+			if dates[key] is None:
+				dates[key] = value
+		if pieces:
+			pieces.append(line[pos:])
+			line = u''.join(pieces)
 
 		return (line.strip(), dates['upphor'], dates['ikrafttrader'])
 
+	def _leadingMarkers(self, line):
+		"""The markers at the start of the line, up to the first char 
+		that isn't in a marker"""
+		pos = 0
+		m = self.reAndringsDatum.match(line, pos)
+		while m:
+			yield m
+			pos = m.end()
+			m = self.reAndringsDatum.match(line, pos)
+
+	def _datum(self, text):
+		"""The datetime of a yyyy-mm-dd date in a marker"""
+		d = self.datumCache.get(text)
+		if d is None:
+			d = datetime(*[int(x) for x in text.split('-')])
+			self.datumCache[text] = d
+		return d
+
 	def guesState(self):
+		"""Returns the make method for the text at the reader position. The
+		make methods asks again when an inner one has returned, so it's 
+		kept with the headline level that isRubrik may have set"""
+		key = ('guesState', self.window.position(), 
+			   self.currentSection, self.currentHeadlineLevel)
+		res = self.window.get(key)
+		if res is not None:
+			(handler, self.currentHeadlineLevel) = res
+			return handler
+		handler = self._guesState()
+		self.window.set(key, (handler, self.currentHeadlineLevel))
+		return handler
+
+	def _guesState(self):
 		try:
-			if self.reader.peekLine() == '':
+			i = self._lineToken()
+			if i is not None:
+				blank = self.lines.has(i, LineTokens.BLANK)
+			else:
+				blank = self.reader.peekLine() == ''
+
+			if blank:
 				handler = self.blankLine
 			elif self.isAvdelning():
 				handler = self.makeAvdelning
@@ -1221,13 +1552,17 @@ class SFSParser(Source.Parser):
 		return handler
 
 	def isAvdelning(self):
-		if '\n' in self.reader.peekParagraph() != '':
+		if self.idOfAvdelning() == None:
 			return False
-		return self.idOfAvdelning() != None
+		return '\n' not in self.window.peek()
 
-	def idOfAvdelning(self):
+	def idOfAvdelning(self, p=None):
 		# There's four types of 'Avdelning', this checks for these patterns
-		p = self.reader.peekLine()
+		if p is None:
+			i = self._lineToken()
+			if i is not None:
+				return self.lines.ordinal(i, LineTokens.AVDELNING)
+			p = self.reader.peekLine()
 		if p.lower().endswith(u'avdelningen') and len(p.split()) == 2:
 			ordinal = p.split()[0]
 			return unicode(self._sweOrd(ordinal))
@@ -1250,8 +1585,13 @@ class SFSParser(Source.Parser):
 				return idStr
 		return None
 
-	def isUpphavtKapitel(self):
-		match = self.reChapterRevoked(self.reader.peekLine())
+	def isUpphavtKapitel(self, p=None):
+		if p is None:
+			i = self._lineToken()
+			if i is not None:
+				return self.lines.has(i, LineTokens.UPPHAVT_KAPITEL)
+			p = self.reader.peekLine()
+		match = self.reChapterRevoked(p)
 		return match != None
 
 	def isKapitel(self, p=None):
@@ -1259,7 +1599,10 @@ class SFSParser(Source.Parser):
 
 	def idOfKapitel(self, p=None):
 		if not p:
-			p = self.reader.peekParagraph().replace('\n', ' ')
+			p = self.window.peek().replace('\n', ' ')
+		return self.window.cached(('idOfKapitel', p), self._idOfKapitel, p)
+
+	def _idOfKapitel(self, p):
     	
 		# Things that might look like the start of a chapter is often
 		# the start of a paragraph in a section listing the names of chapters
@@ -1292,8 +1635,14 @@ class SFSParser(Source.Parser):
 			return None
 
 	def isRubrik(self, p=None):
+		if p:
+			return self.window.cached(('isRubrik', p, self.currentSection), 
+									  self._isRubrik, p)
+		return self._isRubrik(p)
+
+	def _isRubrik(self, p=None):
 		if p == None:
-			p = self.reader.peekParagraph()
+			p = self.window.peek()
 			indirect = False
 		else:
 			indirect = True
@@ -1325,7 +1674,7 @@ class SFSParser(Source.Parser):
 			return False
 
 		try:
-			nextp = self.reader.peekParagraph(2)
+			nextp = self.window.peek(2)
 		except IOError:
 			nextp = u''
 
@@ -1340,13 +1689,22 @@ class SFSParser(Source.Parser):
 
 		return True
 
-	def isUpphavdParagraf(self):
-		match = self.reSectionRevoked(self.reader.peekLine())
+	def isUpphavdParagraf(self, p=None):
+		if p is None:
+			i = self._lineToken()
+			if i is not None:
+				return self.lines.has(i, LineTokens.UPPHAVD_PARAGRAF)
+			p = self.reader.peekLine()
+		match = self.reSectionRevoked(p)
 		return match != None
 
 	def isParagraf(self, p=None):
 		if not p:
-			p = self.reader.peekParagraph()
+			p = self.window.peek()
+		return self.window.cached(('isParagraf', p, self.currentSection), 
+								  self._isParagraf, p)
+
+	def _isParagraf(self, p):
     	
 		paragrafNr = self.idOfParagraf(p)
 		if paragrafNr == None:
@@ -1379,11 +1737,23 @@ class SFSParser(Source.Parser):
 				return None
 
 	def isTabell(self, p=None, assumeTable=False, reqCols=False):
-		shortLine = 55
-		shorterLine = 52
+		if reqCols and p:
+			# Only depends on p
+			return self.window.cached(('tabellKolumner', p), 
+									  self._hasTabellKolumner, p)
 		if not p:
-			p = self.reader.peekParagraph()
+			# The paragraph at the reader position, by its offset so 
+			# that a row is only classified once
+			p = self.window.peek()
+			key = ('isTabell', self.window.position(), assumeTable, reqCols,
+				   self.currentSection)
+		else:
+			key = ('isTabell', p, assumeTable, reqCols, 
+				   self.window.position(), self.currentSection)
+		return self.window.cached(key, self._isTabell, p, assumeTable, reqCols)
 
+	def _tabellLines(self, p):
+		"""The lines of the table that p begins with"""
 		# Find tables that formated so the right colum extends an
 		# extra row. Two tables that are read as one.
 		lines = []
@@ -1397,7 +1767,30 @@ class SFSParser(Source.Parser):
 					break
 				else:
 					lines.append(l)
+		return lines
 
+	def _hasTabellKolumner(self, p):
+		"""The rows of p are separated in columns, this is all that's 
+		tested with reqCols"""
+		lines = self._tabellLines(p)
+		numLines = len(lines)
+
+		# 2. Has more than one space in a row on each row
+		matches = [l for l in lines if '  ' in l]
+		if numLines > 1 and len(matches) == numLines:
+			return True
+
+		# 4. Is one row with clear tabelseperation
+		if numLines == 1 and '   ' in lines[0]:
+			return True
+
+		return False
+
+	def _isTabell(self, p, assumeTable, reqCols):
+		shortLine = 55
+		shorterLine = 52
+
+		lines = self._tabellLines(p)
 		numLines = len(lines)
 		# Trying to guess if this section is a table 
 		# 1. Could be if it's short: 
@@ -1407,11 +1800,11 @@ class SFSParser(Source.Parser):
 				return True
 			if len(matches) == numLines:
 				try:
-					p2 = self.reader.peekParagraph(2)
+					p2 = self.window.peek(2)
 				except IOError:
 					p2 = ''
 				try:
-					p3 = self.reader.peekParagraph(3)
+					p3 = self.window.peek(3)
 				except IOError:
 					p3 = ''
 				if not assumeTable and not self.isTabell(p2, 
@@ -1433,9 +1826,8 @@ class SFSParser(Source.Parser):
 						return False
 				return True
 
-		# 2. Has more than one space in a row on each row
-		matches = [l for l in lines if '  ' in l]
-		if numLines > 1 and len(matches) == numLines:
+		# 2. and 4.
+		if self.window.cached(('tabellKolumner', p), self._hasTabellKolumner, p):
 			return True
 
 		# 3. Is short (1.) or has the spaces in (2.)
@@ -1444,10 +1836,6 @@ class SFSParser(Source.Parser):
 			if len(matches) == numLines:
 				return True
 
-		# 4. Is one row with clear tabelseperation
-		if numLines == 1 and '   ' in l:
-			return True
-
 		return False
 
 	def isNumreradLista(self, p=None):
@@ -1455,6 +1843,9 @@ class SFSParser(Source.Parser):
 
 	def idOfNumreradLista(self, p=None):
 		if not p:
+			i = self._lineToken()
+			if i is not None:
+				return self.lines.ordinal(i, LineTokens.NUMRERAD_LISTA)
 			p = self.reader.peekLine()
 		match = self.reDottedNumber.match(p)
 		if match != None:
@@ -1468,6 +1859,9 @@ class SFSParser(Source.Parser):
 
 	def isStrecksatsLista(self, p=None):
 		if not p:
+			i = self._lineToken()
+			if i is not None:
+				return self.lines.has(i, LineTokens.STRECKSATS_LISTA)
 			p = self.reader.peekLine()
 
 		return (p.startswith('- ') or
@@ -1477,30 +1871,30 @@ class SFSParser(Source.Parser):
 	def isBokstavsLista(self):
 		return self.idOfBokstavsLista() != None
 
-	def idOfBokstavsLista(self):
-		p = self.reader.peekLine()
+	def idOfBokstavsLista(self, p=None):
+		if p is None:
+			i = self._lineToken()
+			if i is not None:
+				return self.lines.ordinal(i, LineTokens.BOKSTAVS_LISTA)
+			p = self.reader.peekLine()
 		match = self.reBokstavsLista.match(p)
 		if match != None:
 			return match.group(1).replace(' ', '')
 		return None
 
 	def isOvergangsbestammelser(self):
-		sep = [u'vergngsbestmmelser',
-			   u'Ikrafttrdande- och vergngsbestmmelser',
-			   u'vergngs- och ikrafttrdandebestmmelser']
 		l = self.reader.peekLine()
-		if l not in sep:
-			fuzz = difflib.get_close_matches(l, sep, 1, 0.9)
-			if fuzz:
-				pass
-				#TODO: Log warning, did you mean?
-			else:
-				return False
+		sep = self.overgangsMatcher.match(l)
+		if sep is None:
+			return False
+		elif sep != l:
+			pass
+			#TODO: Log warning, did you mean?
 		try:
 			# If the sep 'vergngsbestmmelser' is followed by a 
 			# regular paragraph, it's probably not a sep, but an 
 			# ordinary headline.
-			np = self.reader.peekParagraph(2)
+			np = self.window.peek(2)
 			if self.isParagraf(np):
 				return False
 		except IOError:
@@ -1508,11 +1902,21 @@ class SFSParser(Source.Parser):
 
 		return True
 
-	def isOvergangsbestammelse(self):
-		return self.reSimpleSfsId.match(self.reader.peekLine())
+	def isOvergangsbestammelse(self, p=None):
+		if p is None:
+			i = self._lineToken()
+			if i is not None:
+				return self.lines.has(i, LineTokens.OVERGANGSBESTAMMELSE)
+			p = self.reader.peekLine()
+		return self.reSimpleSfsId.match(p)
 
-	def isBilaga(self):
-		(line, upphor, ikrafttrader) = self.andringsDatum(self.reader.peekLine())
+	def isBilaga(self, p=None):
+		if p is None:
+			i = self._lineToken()
+			if i is not None:
+				return self.lines.has(i, LineTokens.BILAGA)
+			p = self.reader.peekLine()
+		(line, upphor, ikrafttrader) = self.andringsDatum(p)
 		return (line in (u'Bilaga', 
 						 u'Bilaga*',
 						 u'Bilaga *',
@@ -1529,68 +1933,130 @@ class SFSController(Source.Controller):
 		print "## Create SFS Controller"
 	
 	__parserClass = SFSParser
+	__parser = None
+
+	# The modules that the result of each action depends on, a change in
+	# others like Benchmark.py or Controller.py doesn't rebuild anything
+	parseCode = ('SFS.py', 'Reference.py', 'Source.py', 'Util.py', 
+				 'TextReader.py', 'DataObjects.py', 'KnowledgeBase.py',
+				 'Index.py')
+	generateCode = ('SFS.py', 'Util.py')
+
+	versionFiles = {'Parse': {'code': parseCode,
+							  'grammar': ('etc/*.ebnf',),
+							  'n3': ('etc/*.n3',),
+							  'templates': ('etc/*.template.xht2',)},
+					'Generate': {'code': generateCode,
+								 'xsl': ('xsl/*.xsl',)},
+					'Build': {'code': parseCode,
+							  'grammar': ('etc/*.ebnf',),
+							  'n3': ('etc/*.n3',),
+							  'templates': ('etc/*.template.xht2',),
+							  'xsl': ('xsl/*.xsl',)}}
 
 	## Controller Interface ##
 
 	def Parse(self, f, v=False):		
+		f = f.replace(":", "/")
 		try:
-			f = f.replace(":", "/")
-			files = {'sfst':self.__listfiles('sfst',f), 
-					 'sfsr':self.__listfiles('sfsr',f)}
-			if (not files['sfst'] and not files['sfsr']):
-				raise Source.NoFiles("No files found for %s" % f)
-			filename = self._xmlName(f)
-
-			if config.debug:
-				print "All files connected to this file: ",
-				print files
-				print "XML filename: ",
-				print filename
-
-			# Three checks before we start to parse
-
-			# 1: Filter out stuff that's not a proper SFS document
-			# They will look something like "N1992:31"
-			if '/N' in f:
-				raise NotSFS()
-
-			# 2: If the outfile is newer then all ingoing files, don't parse.
-			#TODO: Add force option to config? 
-			fList = []
-			for x in files.keys():
-				if self._fileUpToDate(fList, filename):
-					return
-				else:
-					fList.extend(files[x])
-
-			# 3: Skip the documents that have been revoked and are marked
-			# as "Frfattningen r upphvd/skall upphvas"
-			t = TextReader(files['sfsr'][0], encoding="iso-8859-1")
-			try:
-				t.cuepast(u'<i>Frfattningen r upphvd/skall upphvas: ')
-				datestr = t.readTo(u'</i></b>')
-				if datetime.strptime(datestr, '%Y-%m-%d') < datetime.today():
-					raise RevokedDoc()
-					#TODO: log 'expired' document
-			except IOError:
-				pass
-
-			# Actual parsing begins here.
-			p = SFSParser()
-			parsed = p.Parse(f, files)
-			tmpFile = mktemp()
-			out = file(tmpFile, 'w')
-			out.write(parsed)
-			out.close()
-			Util.replaceUpdated(tmpFile, filename)
+			res = self._parseDocument(f, 'Parse', self._xmlName(f))
+		except (RevokedDoc, NotSFS):
+			self._removeDocument(f)
+			return
+		if res:
+			self._writeParsed(f, *res)
 			return '(.. sec )'
 
-		except RevokedDoc:
-			Util.remove(filename)
-			Util.remove(Util.relpath(self._htmlName(f)))
-		except NotSFS:
-			Util.remove(filename)
-			Util.remove(Util.relpath(self._htmlName(f)))
+	def Build(self, f):
+		"""Parses f and generates the HTML from the parsed XHTML in memory, 
+		the .xht2 file is only written if config.writeParsed is set"""
+		f = f.replace(":", "/")
+		outfile = Util.relpath(self._htmlName(f))
+		try:
+			res = self._parseDocument(f, 'Build', outfile)
+		except (RevokedDoc, NotSFS):
+			self._removeDocument(f)
+			return
+		if not res:
+			return
+		(inputs, parsed) = res
+		if config.writeParsed:
+			self._writeParsed(f, inputs, parsed)
+
+		Util.mkdir(os.path.dirname(outfile))
+		params = {}
+		with Benchmark.phase('transform'):
+			Util.transformString(__scripDir__ + '/xsl/sfs.xsl',
+								 parsed,
+								 outfile,
+								 parameters=params,
+								 baseUrl=Util.relpath(self._xmlName(f)))
+		output = Manifest.hashFile(outfile)
+		self._recordBuild(f, 'Build', inputs, output)
+		if config.writeParsed:
+			self._recordBuild(f, 'Generate', 
+							  self._hashInputs([Util.relpath(self._xmlName(f))]), output)
+
+	def BuildAll(self):
+		dlDir = os.path.sep.join([self.baseDir, u'sfs', 'dl', 'sfst'])
+		self._runMethod(dlDir, 'html', self.Build)
+
+	def _parseDocument(self, f, action, outfile):
+		"""Returns the hash of the downloaded files and the parsed XHTML, or 
+		None if outfile is already built from them by action"""
+		files = {'sfst':self.__listfiles('sfst',f), 
+				 'sfsr':self.__listfiles('sfsr',f)}
+		if (not files['sfst'] and not files['sfsr']):
+			raise Source.NoFiles("No files found for %s" % f)
+
+		if config.debug:
+			print "All files connected to this file: ",
+			print files
+			print "Out filename: ",
+			print outfile
+
+		# Three checks before we start to parse
+
+		# 1: Filter out stuff that's not a proper SFS document
+		# They will look something like "N1992:31"
+		if '/N' in f:
+			raise NotSFS()
+
+		# 2: If the outfile was built from the same files by the same 
+		# code, grammars and templates, don't parse. Use -f to force
+		inputs = self._hashInputs(files['sfst'] + files['sfsr'])
+		if self._isBuilt(f, action, inputs, outfile):
+			return None
+
+		# 3: Skip the documents that have been revoked and are marked
+		# as "Frfattningen r upphvd/skall upphvas"
+		t = TextReader(files['sfsr'][0], encoding="iso-8859-1")
+		try:
+			t.cuepast(u'<i>Frfattningen r upphvd/skall upphvas: ')
+			datestr = t.readTo(u'</i></b>')
+			if datetime.strptime(datestr, '%Y-%m-%d') < datetime.today():
+				raise RevokedDoc()
+				#TODO: log 'expired' document
+		except IOError:
+			pass
+
+		# Actual parsing begins here.
+		return (inputs, self._getParser().Parse(f, files))
+
+	def _writeParsed(self, f, inputs, parsed):
+		filename = self._xmlName(f)
+		tmpFile = mktemp()
+		out = file(tmpFile, 'w')
+		out.write(parsed)
+		out.close()
+		Util.replaceUpdated(tmpFile, filename)
+		self._recordBuild(f, 'Parse', inputs, Manifest.hashString(parsed))
+
+	def _removeDocument(self, f):
+		"""Removes the results for a document that shouldn't be published"""
+		Util.remove(self._xmlName(f))
+		Util.remove(Util.relpath(self._htmlName(f)))
+		self._manifest().forget(f)
 
 	def ParseAll(self):	
 		dlDir = os.path.sep.join([self.baseDir, u'sfs', 'dl', 'sfst'])
@@ -1628,16 +2094,30 @@ class SFSController(Source.Controller):
 			#self.generateAnno(annotations, f)
 			pass
 
+		inputs = self._hashInputs([infile])
+		if self._isBuilt(f, 'Generate', inputs, outfile):
+			return
+
 		Util.mkdir(os.path.dirname(outfile))
 		#params = {'annotationfile':'../data/sfs/intermediate/%s.ann.xml' % f}
 		params = {}
-		Util.transform(__scripDir__ + '/xsl/sfs.xsl',
-					   infile,
-					   outfile,
-					   parameters= params,
-					   validate=False)
+		with Benchmark.phase('transform'):
+			Util.transform(__scripDir__ + '/xsl/sfs.xsl',
+						   infile,
+						   outfile,
+						   parameters= params,
+						   validate=False)
+		self._recordBuild(f, 'Generate', inputs, Manifest.hashFile(outfile))
 		return
 
+	def _getParser(self):
+		"""Returns the parser used for all documents, it's expensive to 
+		create so it's reused and reset by Parse for each document"""
+		if self.__parser is None:
+			self.__parser = self.__parserClass()
+			Source.loadTemplate(__moduledir__)
+		return self.__parser
+
 	## Methods that overrides Controller methods ##
 
 	def _get_module_dir(self):
@@ -6,17 +6,25 @@
 import os
 import sys
 import re
+import glob
 import config
 import time
+import signal
+import traceback
+import multiprocessing
 from tempfile import mktemp
 
 #3rd party libs
-from rdflib import RDFS
-from rdflib.Graph import Graph
 from genshi.template import TemplateLoader
 
 #Own libs
 import Util
+import Index
+import Manifest
+import Benchmark
+import Stats
+import Journal
+import KnowledgeBase
 
 __scriptDir__ = os.getcwd()
 
@@ -32,22 +40,30 @@ class Parser(object):
 	reNormalizedSpace = re.compile(r'\s+',).sub
 
 	def __init__(self):
-		self.authRec = self.loadAuthRec(__scriptDir__ + "/etc/authrec.n3")
+		self.authRec = self.loadAuthRec()
+		self.authRecIndex = Index.PrefixTrie(self.authRec.items())
+		self.authRecFuzz = Index.NgramIndex(self.authRec.keys())
+		self.authRecMatches = {}
 
 	def Parse(self):
 		raise NotImplementedError
 
+	def reset(self):
+		"""Clears the state from the last parsed document, a parser is 
+		reused for many documents"""
+		pass
+
 	def generateXhtml(self, meta, body, registry, module, globals):
 		"""Create a XTHML representation of the document"""
-		loader = TemplateLoader(['.', os.path.dirname(__file__)],
-								variable_lookup='lenient')
-		t = loader.load('etc/%s.template.xht2'%module)
-		stream = t.generate(meta=meta, body=body, registry=registry, **globals)
+		t = loadTemplate(module)
+		with Benchmark.phase('template'):
+			stream = t.generate(meta=meta, body=body, registry=registry, **globals)
 
-		try:
-			res = stream.render()
-		except Exception, e:
-			raise
+			try:
+				res = stream.render()
+			except Exception, e:
+				raise
+		Benchmark.size('xhtml', len(res))
 		if 'class="warning"' in res:
 			start = res.index('class="warning">')
 			end = res.index('</',start+16)
@@ -55,33 +71,41 @@ class Parser(object):
 
 		return res
 
-	def loadAuthRec(self, n3File):
-		"""Load a RDF graph with authority posts in n3-format"""
-		g = Graph()
-		n3File = Util.relpath(n3File)
-		g.load(n3File, format='n3')
-		d = {}
-		for uri, label in g.subject_objects(RDFS.label):
-			d[unicode(label)] = unicode(uri)
-		return d
+	def loadAuthRec(self):
+		"""Load the authority posts, compiled from etc/authrec.n3"""
+		return KnowledgeBase.load().table('authrec')
 
 	def findAuthRec(self, label):
 		"""Given a string that refers to some type of organisation, person etc 
 		return a URI for that"""
-		keys = []
-		for (key, value) in self.authRec.items():
-			if label.lower().startswith(key.lower()):
-				return self.storageUri(value)
-			else:
-				keys.append(key)
+		if label in self.authRecMatches:
+			return self.authRecMatches[label]
 
-		#TODO: Add 'fuzz' to find close matches.
-		#fuzz = difflib.get_close_matches(label, keys, 1, 0.8) ...
+		value = self.authRecIndex.longestPrefix(label)
+		if value is None:
+			# No record that the label starts with, try a close match
+			key = self.authRecFuzz.closeMatch(label, 0.8)
+			if key is not None:
+				value = self.authRec[key]
+
+		if value is None:
+			res = None
+		else:
+			res = self.storageUri(value)
+		self.authRecMatches[label] = res
+		return res
 
 	def storageUri(self, value):
 		return value.replace(" ", '_')
 
 class Controller(object):
+
+	# Source files that the result of an action depends on, as glob 
+	# patterns by version name. Subclasses lists them for each action
+	versionFiles = {}
+
+	__manifest = None
+
 	def __init__(self):
 		self.moduleDir = self._get_module_dir()
 		self.baseDir = os.path.dirname(__file__)+os.path.sep+config.datadir
@@ -104,6 +128,14 @@ class Controller(object):
 		parsed = os.path.sep.join([self.baseDir, self.moduleDir, u'parsed'])
 		self._runMethod(parsed, '.xht2', self.Generate)
 
+	def Build(self, f):
+		"""Parse and generate HTML for a document in one go"""
+		raise NotImplementedError
+
+	def BuildAll(self):
+		dlDir = os.path.sep.join([self.baseDir, self.moduleDir, u'dl'])
+		self._runMethod(dlDir, 'html', self.Build)
+
 
 	## Useable functions for subclasses, can be overriden ##
 
@@ -117,22 +149,118 @@ class Controller(object):
 			else:
 				yield fileName
 
+	def Benchmark(self):
+		"""Parse the pinned corpus in etc/benchmark.<module>.txt and report 
+		the time of each phase. Every document is parsed, even if the
+		manifest has it as up to date"""
+		config.benchmark = 1
+		config.force = 1
+		self._runFiles(Benchmark.loadCorpus(self.moduleDir), self.Parse)
+
 	def _runMethod(self, dir, suffix, method):
 		files = self._trimFileName(Util.listDirs(dir, suffix, reverse=True))		
-		nrOfFiles = 0
-		currentTime = time.time()
-		for f in files:
-			if config.debug:
-				print "Running file: ", f, " with method: ", method		
-			if config.benchmark:
-				nrOfFiles += 1
-				print nrOfFiles,",",f,
-			try:
-				method(f)
+		journal = Journal.Journal(self._journalName(method), config.resume)
+		try:
+			files = journal.pending(files)
+			if config.resume:
+				print "Resuming %s, %d documents done, %d to go" % (
+					method.__name__, len(journal.done), len(files))
+			self._runFiles(files, method, journal)
+		finally:
+			journal.close()
+		if journal.failed:
+			print "%d documents failed, the tracebacks are in %s" % (
+				len(journal.failed), Util.relpath(journal.filename))
+
+	def _runFiles(self, files, method, journal=None):
+		"""Runs method for every file. An exception in a file is printed 
+		and recorded in the journal, and the run goes on with the next"""
+		if config.processes > 1:
+			records = self._runPool(files, method, journal)
+		else:
+			records = []
+			nrOfFiles = 0
+			for f in files:
+				if config.debug:
+					print "Running file: ", f, " with method: ", method		
+				Benchmark.start(f, method.__name__)
+				try:
+					method(f)
+					error = None
+				except KeyboardInterrupt:
+					raise
+				except Exception:
+					error = traceback.format_exc()
+				record = Benchmark.finish(error=bool(error))
+				self._journal(journal, f, error)
 				if config.benchmark:
-					print ",",time.time()-currentTime
-			except KeyboardInterrupt:
-				raise
+					records.append(record)
+					nrOfFiles += 1
+					print nrOfFiles,",",f,",",record['total']
+		if config.benchmark:
+			Benchmark.report(records, method.__name__)
+		if config.referenceStats:
+			Stats.report(method.__name__)
+
+	def _runPool(self, files, method, journal=None):
+		"""Runs method for every file in a pool of worker processes. The 
+		workers live through the whole run and the results are handled as 
+		they're done. Returns the benchmark records"""
+		files = list(files)
+		pool = multiprocessing.Pool(config.processes, _initWorker,
+									(self.__class__.__module__, self.__class__.__name__))
+		try:
+			results = pool.imap_unordered(_runWorker, 
+										  [(method.__name__, f) for f in files])
+			pool.close()
+
+			lost = False
+			left = set(files)
+			records = []
+			nrOfFiles = 0
+			while left:
+				try:
+					(f, error, record, stats) = results.next(config.workerTimeout)
+				except StopIteration:
+					break
+				except multiprocessing.TimeoutError:
+					# No worker has finished a file for that long, the files
+					# left are on workers that are hung or have died. They're
+					# all given up at once, not after a timeout each
+					lost = True
+					for f in files:
+						if f in left:
+							self._journal(journal, f, 'No result after %s s' % config.workerTimeout)
+					break
+				left.discard(f)
+				Stats.merge(stats)
+				if config.benchmark and record:
+					records.append(record)
+					nrOfFiles += 1
+					print nrOfFiles,",",f,",",record['total']
+				self._journal(journal, f, error)
+		except KeyboardInterrupt:
+			pool.terminate()
+			raise
+
+		if lost:
+			pool.terminate()
+		else:
+			pool.join()
+		return records
+
+	def _journal(self, journal, f, error):
+		if error:
+			print "Error in %s: %s" % (f, error)
+		if journal is None:
+			return
+		if error:
+			journal.fail(f, error)
+		else:
+			journal.finish(f)
+
+	def _journalName(self, method):
+		return u'%s/%s/journal/%s.journal' % (self.baseDir, self.moduleDir, method.__name__)
 
 	def _fileUpToDate(self, infiles, outfile):
 		"""Check if the outfile is up-to-date, then there's no need to regenerate."""
@@ -144,6 +272,35 @@ class Controller(object):
 				return False
 		return True
 
+	def _manifest(self):
+		"""Returns the build manifest, it's opened in the process that uses 
+		it since SQLite connections can't be shared by worker processes"""
+		if self.__manifest is None:
+			self.__manifest = Manifest.Manifest(u'%s/%s/manifest.sqlite' % 
+												(self.baseDir, self.moduleDir))
+		return self.__manifest
+
+	def _hashInputs(self, infiles):
+		return Manifest.hashInputs(infiles, self.baseDir)
+
+	def _version(self, action):
+		"""Returns the version of the source files that action depends on"""
+		versions = self.versionFiles.get(action, {})
+		return u';'.join([u'%s=%s' % (name, Manifest.sourceVersion(versions[name]))
+						  for name in sorted(versions.keys())])
+
+	def _isBuilt(self, f, action, inputs, outfile):
+		"""Check if outfile was built from the same inputs by the same 
+		version of the code, then there's no need to build it again"""
+		if config.force:
+			return False
+		return self._manifest().isUpToDate(f, action, inputs, 
+										   self._version(action), outfile)
+
+	def _recordBuild(self, f, action, inputs, output):
+		"""Record that f was built, output is the hash of the result"""
+		self._manifest().record(f, action, inputs, self._version(action), output)
+
 	def _htmlName(self, f):
 		"""Return a XHTML file name for the given file"""
 		if not isinstance(f, unicode):
@@ -165,4 +322,53 @@ class Controller(object):
 		if os.path.exists(dependFile):
 			for dep in codecs.open(dependFile, encoding='utf-8'):
 				depends.append(dep.strip())
-		return depends
\ No newline at end of file
+		return depends
+
+# Compiled templates by module, with the mtimes of the template files
+# when they were loaded
+_templates = {}
+
+def loadTemplate(module):
+	"""Returns the compiled template for module. It's compiled once per 
+	process and again only when a template file has been changed, call 
+	it at startup to have it ready for the first document"""
+	mtimes = _templateMtimes()
+	if module in _templates and _templates[module][1] == mtimes:
+		return _templates[module][0]
+
+	# A new loader, the old one has cached the templates that are included
+	loader = TemplateLoader(['.', os.path.dirname(__file__)],
+							variable_lookup='lenient', auto_reload=False)
+	t = loader.load('etc/%s.template.xht2' % module)
+	_templates[module] = (t, mtimes)
+	return t
+
+def _templateMtimes():
+	"""The mtimes of all template files, a template can include the others"""
+	files = sorted(glob.glob(os.path.join(__scriptDir__, 'etc', '*.template.xht2')))
+	return tuple([os.path.getmtime(f) for f in files])
+
+# The controller used by a worker process in Controller._runPool, it's
+# created once when the process starts and used for all its files
+_workerController = None
+
+def _initWorker(moduleName, className):
+	"""Creates the controller for a worker process"""
+	global _workerController
+	# Ctrl-C is handled by the parent, it terminates the whole pool
+	signal.signal(signal.SIGINT, signal.SIG_IGN)
+	__import__(moduleName)
+	_workerController = getattr(sys.modules[moduleName], className)()
+
+def _runWorker(task):
+	"""Runs a controller method for a file in a worker process, task is
+	the name of the method and the file. Returns the file, the error as a
+	traceback, so one bad document doesn't stop the pool, the benchmark 
+	record and the stats counted for the file"""
+	(methodName, f) = task
+	Benchmark.start(f, methodName)
+	try:
+		getattr(_workerController, methodName)(f)
+	except Exception:
+		return (f, traceback.format_exc(), Benchmark.finish(error=True), Stats.take())
+	return (f, None, Benchmark.finish(), Stats.take())
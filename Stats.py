@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# -*- coding: iso-8859-1 -*-
+"""Counters for the reference parser, turned on by the -s flag. The
+counters are kept in sections, like the productions of a grammar, and
+the workers in a pool send theirs to the parent with every result"""
+
+#Libs
+import os
+import json
+import time
+import socket
+
+#Own libs
+import config
+import Util
+
+__scriptDir__ = os.getcwd()
+
+# Counters by section and name for this process
+_sections = {}
+
+def add(section, name, n=1):
+	"""Adds n to a counter, n can be a number of seconds"""
+	counters = _sections.setdefault(section, {})
+	counters[name] = counters.get(name, 0) + n
+
+def declare(section, names):
+	"""Adds the names with 0 if they're not counted yet, so they're in
+	the report even if they're never seen"""
+	counters = _sections.setdefault(section, {})
+	for name in names:
+		counters.setdefault(name, 0)
+
+def take():
+	"""Returns the counters and starts over, used by the workers"""
+	global _sections
+	sections = _sections
+	_sections = {}
+	return sections
+
+def merge(sections):
+	"""Adds the counters from another process"""
+	for (section, counters) in sections.items():
+		for (name, n) in counters.items():
+			add(section, name, n)
+
+def summary(sections):
+	"""The totals of each section and its names that are never counted,
+	as lines of text"""
+	lines = []
+	for section in sorted(sections.keys()):
+		counters = sections[section]
+		lines.append('%s:' % section)
+		unused = sorted([name for (name, n) in counters.items() if not n])
+		for (name, n) in sorted(counters.items(), key=lambda x: -x[1]):
+			if n and isinstance(n, float):
+				lines.append('  %-32s %12.3f' % (name, n))
+			elif n:
+				lines.append('  %-32s %12d' % (name, n))
+		if unused:
+			lines.append('  never seen: %s' % ', '.join(unused))
+	return lines
+
+def write(sections, filename):
+	Util.checkDir(filename)
+	f = open(filename, 'w')
+	json.dump(sections, f, indent=1, sort_keys=True)
+	f.close()
+
+def logName(method):
+	return os.path.join(__scriptDir__, 'logs', 'stats_%s_%s_%s.json' % (
+		method, socket.gethostname().split('.')[0], time.strftime('%Y%m%d_%H%M%S')))
+
+def report(method):
+	"""Writes the counters of the run to logs/ and prints the summary"""
+	filename = logName(method)
+	write(_sections, filename)
+	print
+	print "\n".join(summary(_sections))
+	print "Stats written to %s" % Util.relpath(filename)
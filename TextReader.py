@@ -6,6 +6,8 @@
 import os
 import codecs
 import copy
+from array import array
+from bisect import bisect_left
 
 class TextReader:
 	UNIX = '\n'
@@ -55,12 +57,16 @@ class TextReader:
 		self.currPos = 0
 		self.maxPos = len(self.data)
 		self.lastread = u''
+		self.__offsets = {}
 
 	def __iter__(self):
 		return self
 
 	def __find(self, delimiter, startPos):
-		idx = self.data.find(delimiter, startPos)
+		if delimiter == self.linesep or delimiter == self.linesep * 2:
+			idx = self.__next(delimiter, startPos)
+		else:
+			idx = self.data.find(delimiter, startPos)
 		if idx == -1:
 			res = self.data[startPos:]
 			newPos = startPos + len(res)
@@ -69,6 +75,24 @@ class TextReader:
 			newPos = idx + len(delimiter)
 		return (res, newPos)
 
+	def __next(self, delimiter, startPos):
+		"""The same as data.find, but from a table with the offset of 
+		every delimiter in data. It's made the first time it's needed, 
+		lines and paragraphs are then found without searching the data"""
+		offsets = self.__offsets.get(delimiter)
+		if offsets is None:
+			offsets = array('i')
+			# A paragraph can overlap the one before, as in '\n\n\n'
+			idx = self.data.find(delimiter)
+			while idx != -1:
+				offsets.append(idx)
+				idx = self.data.find(delimiter, idx + 1)
+			self.__offsets[delimiter] = offsets
+		i = bisect_left(offsets, startPos)
+		if i == len(offsets):
+			return -1
+		return offsets[i]
+
 	def __process(self, s):
 		if self.autostrip:
 			s = s.strip()
@@ -141,6 +165,14 @@ class TextReader:
 				oldPos = newPos
 		return self.__process(res)
 
+	def peekChunkAt(self, delimiter, pos):
+		"""The chunk that starts at pos and the position after it, without 
+		moving the reader"""
+		(res, newPos) = self.__find(delimiter, pos)
+		if newPos == pos:
+			raise IOError('Peek past EOF')
+		return (self.__process(res), newPos)
+
 	def getReader(self, callableObj, *args, **kwargs):
 		"""Treats the result of a read, peek or prev method as a new
 		TextReader. Useful to process pages in page-oriented documents"""
@@ -149,6 +181,7 @@ class TextReader:
 		clone.data = res
 		clone.currPos = 0
 		clone.maxPos = len(clone.data)
+		clone.__offsets = {}
 		return clone
 
 	def getIterator(self, callableObj, *args, **kwargs):
@@ -10,10 +10,21 @@ import subprocess
 import shutil
 import locale
 import filecmp
+import glob
+import cPickle
 from tempfile import mktemp
+from collections import OrderedDict
 
 #3rd party libs
 import BeautifulSoup
+try:
+	from lxml import etree
+except ImportError:
+	# Without lxml all transformations are done by xsltproc
+	etree = None
+
+#Own libs
+import config
 
 #Common namespaces and prefixes for them
 ns = {'dc':'http://purl.org/dc/elements/1.1/',
@@ -128,6 +139,73 @@ def forceRename(old, new):
 	except IOError:
 		pass
 
+def cacheFile(name):
+	"""Returns the path for a file in the cache dir"""
+	d = os.path.join(os.getcwd(), config.datadir, config.cachedir)
+	mkdir(d)
+	return os.path.join(d, name)
+
+def removeCached(pattern, keep=None):
+	"""Removes files in the cache dir that matches pattern, except keep"""
+	for f in glob.glob(cacheFile(pattern)):
+		if f != keep:
+			remove(f)
+
+def loadPickle(filename):
+	"""Loads a pickled object, None is returned if the file is missing or 
+	can't be read"""
+	try:
+		f = open(filename, 'rb')
+	except IOError:
+		return None
+	try:
+		try:
+			return cPickle.load(f)
+		except Exception:
+			return None
+	finally:
+		f.close()
+
+def dumpPickle(obj, filename):
+	"""Pickles obj to filename. It's written to a temp file that then 
+	replaces filename, so other processes never reads a half written file"""
+	tmpFile = mktemp(dir=os.path.dirname(filename))
+	f = open(tmpFile, 'wb')
+	try:
+		cPickle.dump(obj, f, cPickle.HIGHEST_PROTOCOL)
+		f.close()
+	except:
+		f.close()
+		remove(tmpFile)
+		raise
+	os.rename(tmpFile, filename)
+
+class LRUCache(object):
+	"""A dict that only keeps the maxsize most recently used items"""
+	def __init__(self, maxsize):
+		self.maxsize = maxsize
+		self.items = OrderedDict()
+
+	def __len__(self):
+		return len(self.items)
+
+	def __contains__(self, key):
+		return key in self.items
+
+	def get(self, key, default=None):
+		try:
+			value = self.items.pop(key)
+		except KeyError:
+			return default
+		self.items[key] = value
+		return value
+
+	def __setitem__(self, key, value):
+		self.items.pop(key, None)
+		self.items[key] = value
+		if len(self.items) > self.maxsize:
+			self.items.popitem(last=False)
+
 def elementText(element):
 	"""Finds the plaintext in a BeautifulSoup element"""
 	return normalizedSpace(
@@ -138,11 +216,53 @@ def elementText(element):
 
 def transform(stylesheet, infile, outfile, parameters={}, validate=True, xinclude=False, keepUnchanged=False):
 	"""Performs a XSLT transformation with the stylesheet and formats the resulting HTML tree and validates it"""
+	if etree is not None and config.lxml:
+		tmpFile = _transformLxml(stylesheet, infile, parameters, xinclude)
+	else:
+		tmpFile = _transformXsltproc(stylesheet, infile, parameters, xinclude)
+
+	if keepUnchanged:
+		replaceUpdated(tmpFile, outfile)
+	else:
+		forceRename(tmpFile, outfile)
+
+	if os.path.exists(tmpFile):
+		os.unlink(tmpFile)
+	if validate:
+		cmdLine = "xmllint --noout --nonet --nowarning --dtdvalid %s/dtd/xhtml1-strict.dtd %s" (basepath, outfile)
+		(ret, stdout, stderr) = runCmd(cmdLine)
+		if (ret != 0):
+			raise ValidationError(stderr)
 
+def transformString(stylesheet, data, outfile, parameters={}, baseUrl=None):
+	"""Like transform, but the document is a string that is never written 
+	to disk. Relative references in it are resolved from baseUrl"""
+	if etree is not None and config.lxml:
+		xslt = loadStylesheet(stylesheet)
+		try:
+			doc = etree.fromstring(data, _xsltParser, base_url=baseUrl).getroottree()
+		except etree.XMLSyntaxError, e:
+			raise TransformError(str(e))
+		tmpFile = _applyLxml(xslt, doc, parameters)
+	else:
+		# xsltproc can only read files
+		infile = mktemp()
+		f = open(infile, 'wb')
+		f.write(data)
+		f.close()
+		try:
+			tmpFile = _transformXsltproc(stylesheet, infile, parameters, False)
+		finally:
+			os.unlink(infile)
+	forceRename(tmpFile, outfile)
+
+def _transformXsltproc(stylesheet, infile, parameters, xinclude):
+	"""Transforms infile with the xsltproc command, returns the temp file 
+	with the result"""
 	# TODO: Not in use until annotations is implemented
 	paramStr = ''
 	for p in parameters.keys():
-		paramStr += "--param %s \"'%s'\" " % (p.parameters[p])
+		paramStr += "--param %s \"'%s'\" " % (p, parameters[p])
 	# TODO: Not in use until annotations is implemented
 
 	if xinclude:
@@ -159,25 +279,98 @@ def transform(stylesheet, infile, outfile, parameters={}, validate=True, xinclud
 
 	(ret, stdout, stderr) = runCmd(cmdLine)
 
+	if xinclude:
+		os.unlink(infile)
 	if (ret != 0):
 		raise TransformError(stderr)
 	if stderr:
 		print 'Transformation error: %s' % stderr
 
-	if keepUnchanged:
-		replaceUpdated(tmpFile, outfile)
-	else:
-		forceRename(tmpFile, outfile)
+	return tmpFile
 
-	if os.path.exists(tmpFile):
-		os.unlink(tmpFile)
-	if xinclude:
-		os.unlink(infile)
-	if validate:
-		cmdLine = "xmllint --noout --nonet --nowarning --dtdvalid %s/dtd/xhtml1-strict.dtd %s" (basepath, outfile)
-		(ret, stdout, stderr) = runCmd(cmdLine)
-		if (ret != 0):
-			raise ValidationError(stderr)
+# Compiled stylesheets by filename, with the mtimes of the stylesheets
+# in its dir when it was compiled
+_stylesheets = {}
+
+# Parses documents with the same options as xsltproc uses, so both ways
+# of transforming gives the same result
+_xsltParser = None
+# The same for stylesheets, the documents they load with document() are
+# also parsed by it
+_stylesheetParser = None
+
+if etree is not None:
+	class MissingDocumentResolver(etree.Resolver):
+		"""Resolves a local file that doesn't exist to an empty document. 
+		document() of a missing file is then empty, as with xsltproc, 
+		instead of stopping the transformation. xsltproc gives an empty 
+		node-set and this an empty document, so a path into it like 
+		document(f)/rdf:RDF is empty with both"""
+		def resolve(self, url, id, context):
+			path = url
+			if path.startswith('file://'):
+				path = path[len('file://'):]
+			if '://' not in path and not os.path.exists(path):
+				return self.resolve_empty(context)
+			return None
+
+def _xmlParser():
+	return etree.XMLParser(load_dtd=True, attribute_defaults=True,
+						   resolve_entities=True, strip_cdata=True,
+						   no_network=False)
+
+def loadStylesheet(stylesheet):
+	"""Returns the compiled lxml stylesheet. It's compiled once per process,
+	and again if the stylesheet or one that it might import changes"""
+	global _xsltParser, _stylesheetParser
+	if _xsltParser is None:
+		_xsltParser = _xmlParser()
+		_stylesheetParser = _xmlParser()
+		_stylesheetParser.resolvers.add(MissingDocumentResolver())
+
+	files = sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(stylesheet)), '*.xsl')))
+	mtimes = tuple([os.path.getmtime(f) for f in files])
+	if stylesheet in _stylesheets and _stylesheets[stylesheet][1] == mtimes:
+		return _stylesheets[stylesheet][0]
+
+	try:
+		xslt = etree.XSLT(etree.parse(stylesheet, _stylesheetParser))
+	except (etree.XMLSyntaxError, etree.XSLTParseError), e:
+		raise TransformError(str(e))
+	_stylesheets[stylesheet] = (xslt, mtimes)
+	return xslt
+
+def _transformLxml(stylesheet, infile, parameters, xinclude):
+	"""Transforms infile with a compiled stylesheet in this process, 
+	returns the temp file with the result"""
+	xslt = loadStylesheet(stylesheet)
+	try:
+		doc = etree.parse(infile, _xsltParser)
+		if xinclude:
+			doc.xinclude()
+	except (etree.XMLSyntaxError, etree.XIncludeError), e:
+		raise TransformError(str(e))
+	return _applyLxml(xslt, doc, parameters)
+
+def _applyLxml(xslt, doc, parameters):
+	"""Applies a compiled stylesheet to a parsed document, returns the 
+	temp file with the result"""
+	params = {}
+	for p in parameters.keys():
+		params[p] = etree.XSLT.strparam(parameters[p])
+	try:
+		result = xslt(doc, **params)
+	except etree.XSLTApplyError, e:
+		raise TransformError(str(e))
+	if xslt.error_log:
+		print 'Transformation error: %s' % xslt.error_log
+
+	# str() serializes with libxslt's xsltSaveResultTo, as xsltproc does
+	tmpFile = mktemp()
+	f = open(tmpFile, 'wb')
+	f.write(str(result))
+	f.close()
+	return tmpFile
 
 def runCmd(cmdLine):
 	if isinstance(cmdLine, unicode):
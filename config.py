@@ -3,8 +3,52 @@
 # legal documents. 
 datadir = 'data'
 
+# Dir inside datadir for files that are only kept to speed 
+# things up, like compiled grammars. It's safe to remove
+cachedir = 'cache'
+
 # Debug variabel, turned on by using the -d flag
 debug = 0
 
-# Benchmark log variabel, turned on by using the -l flag
-benchmark = 0
\ No newline at end of file
+# Benchmark log variabel, turned on by using the -l flag. The time of 
+# each phase of each document is written to logs/ as csv or json, and 
+# the percentiles and the benchmarkTop slowest documents are printed
+benchmark = 0
+benchmarkFormat = 'csv'
+benchmarkTop = 10
+
+# Parse and generate documents even if the build manifest says that 
+# they are up to date, turned on by using the -f flag
+force = 0
+
+# Skip the documents that the last ParseAll, GenerateAll or BuildAll 
+# has finished according to its journal in the data dir, turned on by 
+# using the --resume flag. Documents that failed are tried again
+resume = 0
+
+# Number of worker processes used by ParseAll and GenerateAll, 
+# set with the -p flag. 1 runs everything in this process
+processes = 1
+
+# Seconds to wait for a single document when running with 
+# several processes, after that it's logged as failed
+workerTimeout = 600
+
+# XSLT transformations are done by the xsltproc command. Set this to 1
+# to do them in this process with lxml instead, when it's installed
+lxml = 0
+
+# BuildAll passes the parsed XHTML to the HTML transformation in memory.
+# Set this to 0 to skip writing the parsed .xht2 files as well
+writeParsed = 1
+
+# Number of results from the reference parser that are kept in memory, 
+# 0 turns the cache off. With persistReferenceCache the cache is also 
+# kept in the cache dir between runs
+referenceCache = 20000
+persistReferenceCache = 0
+
+# Counters for the reference parser, turned on by using the -s flag. 
+# Calls, bytes and time in tagging and formatting, and the hits of each
+# production and format_ method are written to logs/ as json
+referenceStats = 0
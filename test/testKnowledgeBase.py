@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+# -*- coding: iso-8859-1 -*-
+"""Tests for the compiled knowledge base, run from the root of the repo
+with python -m unittest discover -s test"""
+
+#Libs
+import os
+import sys
+import unittest
+from tempfile import mktemp
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+#Own libs
+import Util
+import KnowledgeBase
+
+class TestSnapshot(unittest.TestCase):
+
+	def setUp(self):
+		self.filename = KnowledgeBase.build(mktemp())
+		self.data = open(self.filename, 'rb').read()
+
+	def tearDown(self):
+		os.unlink(self.filename)
+		KnowledgeBase._shared = None
+
+	def write(self, filename, data):
+		f = open(filename, 'wb')
+		f.write(data)
+		f.close()
+
+	def testTruncated(self):
+		for size in (0, 1, KnowledgeBase.HEADER.size, len(self.data) // 2,
+					 len(self.data) - 1):
+			self.write(self.filename, self.data[:size])
+			self.assertRaises(KnowledgeBase.KnowledgeBaseError,
+							  KnowledgeBase.KnowledgeBase, self.filename)
+
+	def testLoadRebuilds(self):
+		label = KnowledgeBase.KnowledgeBase(self.filename).table('label').items()
+		snapshot = Util.cacheFile(KnowledgeBase.SNAPSHOT)
+		for data in ('', self.data[:len(self.data) // 2]):
+			Util.checkDir(snapshot)
+			self.write(snapshot, data)
+			KnowledgeBase._shared = None
+			self.assertEqual(KnowledgeBase.load().table('label').items(), label)
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+# -*- coding: iso-8859-1 -*-
+"""Tests for the reference parser, run from the root of the repo with
+python -m unittest discover -s test"""
+
+#Libs
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+#3rd party libs
+from simpleparse.stt.TextTools.TextTools import tag
+
+#Own libs
+import config
+import Util
+import Stats
+from Reference import Reference, Link, TagTree, Node
+
+# Texts like the ones in the documents, with and without references, 
+# references to 'samma lag' and to laws by name
+texts = [u'Enligt 3 kap. 2  ska anskan gras skriftligt.',
+		 u'I 5  frsta stycket 2 och 3 finns bestmmelser om avgift.',
+		 u'Lag (2009:1).',
+		 u'Bestmmelserna i 2 kap. 3-5  miljbalken gller.',
+		 u'Frordning (1998:1234) om ndring i frordningen (1990:100) om avgifter.',
+		 u'Se 4  lagen (1994:200) om mervrdesskatt och 6  samma lag.',
+		 u'Av 7 kap. 1  brottsbalken och 3  samma balk framgr det.',
+		 u'Denna lag trder i kraft den 1 juli 2009.',
+		 u'Anskan ska gras hos myndigheten.',
+		 u'Med &#167; avses paragraf, se 3 .',
+		 u'Enligt 2 kap. 1  regeringsformen och 8 kap. 7  samma lag.',
+		 u'Vad som sgs i socialfrskringsbalken ska tillmpas.',
+		 u'Straff enligt brottsbalken gller.',
+		 u'Reglerna i 1 a  tillmpas ven p 2 b .',
+		 u'Texten har ~ i sig och 3 .',
+		 u'Hyres- och arrendelagen gller.',
+		 u'Vad som anges i 3 och 4  gller.',
+		 u'En tgrd enligt 12 kap. 2  frsta stycket 3 miljbalken.',
+		 u'Se prop. 2008/09:150, bet. 2008/09:FiU20, rskr. 2008/09:300.',
+		 u'Se 3 kap. 4\u20136  lagen (1994:200) och 7 .',
+		 u'Avgift tas ut enligt 3 kap.',
+		 u'2  gller inte.',
+		 u'Avgiften enligt fantasilagen tas ut i efterhand.',
+		 u'Enligt fantasilagen (2099:1) ska avgift betalas.',
+		 u'Avgiften enligt fantasilagen tas ut i efterhand.']
+
+baseUri = u'http://rinfo.lagrummet.se/publ/sfs/2009:1#K1P1'
+
+def links(result):
+	return [(unicode(x), getattr(x, 'uri', None)) for x in result]
+
+class TestCache(unittest.TestCase):
+
+	def parseAll(self, parser):
+		"""The results and the state after each text, for two documents"""
+		res = []
+		for i in range(2):
+			parser.reset()
+			for text in texts:
+				res.append((links(parser.parse(text, baseUri)), parser.lastLaw,
+							sorted(parser.currentNamedLaws.items())))
+		return res
+
+	def testSameAsUncached(self):
+		cached = Reference(Reference.LAGRUM)
+		uncached = Reference(Reference.LAGRUM)
+		uncached.cache = Util.LRUCache(0)
+		self.assertEqual(self.parseAll(cached), self.parseAll(uncached))
+		self.assertTrue(cached.cacheHits)
+		self.assertFalse(uncached.cacheHits)
+
+class TestIsPlain(unittest.TestCase):
+
+	def testPlainIsNotTagged(self):
+		# Tagged as parse did before there was a fast path, a plain text
+		# must come back as it is
+		for args in ((Reference.LAGRUM,), (Reference.FORARBETEN,),
+					 (Reference.LAGRUM, Reference.FORARBETEN)):
+			parser = Reference(*args)
+			parser.reset()
+			plain = []
+			for text in texts:
+				isPlain = parser.isPlain(text)
+				result = links(parser._parse(text, baseUri, None))
+				if isPlain:
+					self.assertEqual(result, [(text, None)])
+					plain.append(text)
+			self.assertTrue(plain)
+			self.assertTrue(len(plain) < len(texts))
+
+	def testNamedLaw(self):
+		parser = Reference(Reference.LAGRUM)
+		parser.reset()
+		self.assertTrue(parser.isPlain(texts[-1]))
+		parser.parse(texts[-2], baseUri)
+		self.assertFalse(parser.isPlain(texts[-1]))
+
+class TestTagTree(unittest.TestCase):
+
+	def oldFind(self, root, nodeTag):
+		"""findNode as it was on the nested tag list, dfs"""
+		if root.tag == nodeTag:
+			return root
+		for node in root.nodes:
+			x = self.oldFind(node, nodeTag)
+			if x != None:
+				return x
+		return None
+
+	def oldFindAll(self, root, nodeTag):
+		if root.tag == nodeTag:
+			return [root]
+		res = []
+		for node in root.nodes:
+			res.extend(self.oldFindAll(node, nodeTag))
+		return res
+
+	def nested(self, node):
+		return (node.tag, node.start, node.end, 
+				[self.nested(n) for n in node.nodes] or None)
+
+	def nestedList(self, children):
+		if not children:
+			return None
+		return [(t, start, end, self.nestedList(c)) for (t, start, end, c) in children]
+
+	def assertSameFind(self, tree, tagNames):
+		"""find and findAll give the same nodes as before from every node"""
+		for i in range(len(tree.tag)):
+			node = Node(tree, i)
+			for tagName in tagNames:
+				self.assertEqual(getattr(self.oldFind(node, tagName), 'id', None),
+								 getattr(tree.find(i, tagName), 'id', None))
+				self.assertEqual([n.id for n in self.oldFindAll(node, tagName)],
+								 [n.id for n in tree.findAll(i, tagName)])
+
+	def testSameAsTagList(self):
+		parser = Reference(Reference.LAGRUM, Reference.FORARBETEN)
+		for text in texts:
+			(data, marks) = parser._escape(text)
+			tagList = tag(data, parser.tagger, 0, len(data))
+			tree = TagTree(tagList, data)
+			self.assertEqual([self.nested(n) for n in tree.root().nodes], 
+							 self.nestedList(tagList[1]) or [])
+			self.assertSameFind(tree, tree.tagNames)
+
+	def testNested(self):
+		# None of the texts has a production inside itself, but findAll 
+		# mustn't return the nodes inside a node it has found
+		tagList = (1, [('A', 0, 4, [('B', 0, 2, [('A', 0, 1, None)]), 
+									('A', 2, 4, [('A', 2, 3, None)])]),
+					   ('B', 4, 6, [('A', 4, 5, None), ('A', 5, 6, None)])], 6)
+		tree = TagTree(tagList, 'abcdef')
+		self.assertSameFind(tree, ('A', 'B', 'C'))
+
+class TestOffsetMap(unittest.TestCase):
+
+	def parseAll(self, args, offsetMap, many):
+		parser = Reference(*args)
+		parser.offsetMap = offsetMap
+		parser.cache = Util.LRUCache(0)
+		parser.reset()
+		if many:
+			return [links(r) for r in parser.parseMany(texts, [baseUri] * len(texts))]
+		return [links(parser.parse(text, baseUri)) for text in texts]
+
+	def testSameAsRewrite(self):
+		# The texts sliced from the source must be the ones the tagged 
+		# text was rewritten back to
+		for args in ((Reference.LAGRUM,), (Reference.FORARBETEN,),
+					 (Reference.LAGRUM, Reference.FORARBETEN)):
+			for many in (False, True):
+				self.assertEqual(self.parseAll(args, True, many),
+								 self.parseAll(args, False, many))
+
+class TestParseMany(unittest.TestCase):
+
+	def setUp(self):
+		self.stats = config.referenceStats
+		config.referenceStats = 1
+		Stats.take()
+
+	def tearDown(self):
+		config.referenceStats = self.stats
+		Stats.take()
+
+	def testNamedLawFromEarlierFragment(self):
+		"""The second fragment is plain until the first has named the law"""
+		fragments = [u'Enligt fantasilagen (2099:1) ska avgift betalas.',
+					 u'Avgiften enligt fantasilagen tas ut i efterhand.']
+		baseUris = [None, None]
+		expected = Reference(Reference.LAGRUM)
+		expected = [expected.parse(f, baseUris[i]) for (i, f) in enumerate(fragments)]
+
+		results = Reference(Reference.LAGRUM).parseMany(fragments, baseUris)
+
+		self.assertEqual([links(r) for r in results],
+						 [links(r) for r in expected])
+		self.assertTrue([x for x in results[1] if isinstance(x, Link)])
+
+	def testSameAsParse(self):
+		# The texts are tagged in one buffer, one of them has the separator
+		fragments = texts + [u''] + texts
+		baseUris = [baseUri] * len(fragments)
+		for args in ((Reference.LAGRUM,), (Reference.FORARBETEN,),
+					 (Reference.LAGRUM, Reference.FORARBETEN)):
+			for cacheSize in (0, 100):
+				parser = Reference(*args)
+				parser.cache = Util.LRUCache(cacheSize)
+				parser.reset()
+				expected = [links(parser.parse(f, baseUris[i])) 
+							for (i, f) in enumerate(fragments)]
+				parser = Reference(*args)
+				parser.cache = Util.LRUCache(cacheSize)
+				parser.reset()
+				results = parser.parseMany(fragments, baseUris)
+				self.assertEqual([links(r) for r in results], expected)
+				# Not tagged one by one after all
+				counters = Stats.take()['reference ' + parser.statsName]
+				self.assertEqual(counters['batches'], 1)
+				self.assertFalse(counters.get('batchFailures'))
+
+class TestStats(unittest.TestCase):
+
+	def setUp(self):
+		self.stats = config.referenceStats
+		config.referenceStats = 1
+		Stats.take()
+
+	def tearDown(self):
+		config.referenceStats = self.stats
+		Stats.take()
+
+	def testFormattersOfGrammar(self):
+		# The lagrum formatters are only declared where they can be used,
+		# a formatter for no production at all is declared for both
+		Reference(Reference.FORARBETEN)
+		Reference(Reference.LAGRUM)
+		sections = Stats.take()
+		forarbeten = sections['formatters forarbeteref']
+		lagrum = sections['formatters sfsrefs-sfsref']
+		self.assertTrue('PropRef' in sections['productions forarbeteref'])
+		self.assertFalse('SFSNr' in sections['productions forarbeteref'])
+		self.assertFalse('SFSNr' in forarbeten)
+		self.assertTrue('SFSNr' in lagrum)
+		self.assertTrue('AlternativeChapterSectionRefs' in forarbeten)
+		self.assertTrue('AlternativeChapterSectionRefs' in lagrum)
+
+if __name__ == '__main__':
+	unittest.main()
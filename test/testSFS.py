@@ -0,0 +1,274 @@
+#!/usr/bin/env python
+# -*- coding: iso-8859-1 -*-
+"""Tests for the SFS parser, run from the root of the repo with 
+python -m unittest discover -s test"""
+
+#Libs
+import os
+import re
+import sys
+import random
+import difflib
+import unittest
+from datetime import datetime
+from itertools import permutations
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+#Own libs
+import Util
+import SFS
+from SFS import TabellRad, TabellCell
+
+class Reader(object):
+	linesep = u'\r\n'
+
+def oldMakeTabellRad(self, p, tabstops=None, kwargs={}):
+	"""makeTabellRad as it was when the gutters were found char by char"""
+	def makeTabellCell(text):
+		if len(text) > 1:
+			text = self.reDehypenate('', text)
+		return TabellCell([Util.normalizedSpace(text)])
+
+	cols = [u'', u'',u'', u'',u'', u'',u'', u'']
+	if tabstops:
+		staticTabstops = True
+	else:
+		staticTabstops = False
+		tabstops = [0,0,0,0,0,0,0,0]
+	lines = p.split(self.reader.linesep)
+	numLines = len([x for x in lines if x])
+	potentialRows = len([x for x in lines if x and (x[0].isupper() or x[0].isdigit())])
+	lineCount = 0
+	if (numLines > 1 and numLines == potentialRows):
+		singleLine = True
+	else:
+		singleLine = False
+
+	rows = []
+	emptyLeft = False
+	for l in lines:
+		if l == '':
+			continue
+		lineCount += 1
+		charCount = 0
+		spaceCount =0
+		lastTab = 0
+		colCount = 0
+		if singleLine:
+			cols = [u'', u'',u'', u'',u'', u'',u'', u'']
+		if l[0] == ' ':
+			emptyLeft = True
+		else:
+			if emptyLeft:
+				rows.append(cols)
+				cols = [u'', u'',u'', u'',u'', u'',u'', u'']
+				emptyLeft = False
+
+		for c in l:
+			charCount += 1
+			if c == u' ':
+				spaceCount += 1
+			else:
+				if spaceCount > 1:
+					# We have found a new table cell
+					cols[colCount] += u'\n' + l[lastTab:charCount-(spaceCount+1)]
+					lastTab = charCount -1
+
+					# Handle empty left cells
+					if lineCount > 1 or staticTabstops:
+						if tabstops[colCount+1] + 7 < charCount:
+							if len(tabstops) <= colCount + 2:
+								tabstops.append(0)
+								cols.append(u'')
+							if tabstops[colCount+2] != 0:
+								colCount += 1
+					colCount += 1
+					if len(tabstops) <= charCount:
+						tabstops.append(0)
+						cols.append(u'')
+					tabstops[colCount] = charCount
+				spaceCount = 0
+		cols[colCount] += u'\n' + l[lastTab:charCount]
+		if singleLine:
+			rows.append(cols)	
+
+	if not singleLine:
+		rows.append(cols)
+
+	res = []
+	for r in rows:
+		tr = TabellRad(**kwargs)
+		emptyOk = True
+		for c in r:
+			if c or emptyOk:
+				tr.append(makeTabellCell(c.replace('\n', ' ')))
+				if c.strip() != u'':
+					emptyOk = False
+		res.append(tr)
+
+	return (res, tabstops)
+
+class TestTabellRad(unittest.TestCase):
+
+	# Tables like the ones in the documents, the first line of a row can
+	# be continued on the next, and a left cell can be empty
+	tables = [u'Avgift fr anskan          100 kr\r\nAvgift fr tillstnd        1 000 kr',
+			  u'1. Stora fretag     500   1 000\r\n2. Sm fretag       100     200',
+			  u'Verksamhet som avser      2 000 kr\r\ntillverkning av   \r\n  lkemedel',
+			  u'Lag (1994:200)   1    Mervrdes-\r\n                       skatt',
+			  u'                 1 \r\nLag (1994:200)   2    Avgift']
+
+	def setUp(self):
+		self.parser = SFS.SFSParser()
+		self.parser.reader = Reader()
+
+	def rows(self, makeTabellRad, text, tabstops):
+		try:
+			(rows, tabstops) = makeTabellRad(self.parser, text, tabstops and list(tabstops))
+		except IndexError:
+			# More cells than tabstops
+			return 'IndexError'
+		return ([[unicode(c[0]) for c in r] for r in rows], tabstops)
+
+	def assertSameRows(self, text, tabstops=None):
+		self.assertEqual(self.rows(SFS.SFSParser.makeTabellRad.im_func, text, tabstops),
+						 self.rows(oldMakeTabellRad, text, tabstops))
+
+	def testTables(self):
+		for text in self.tables:
+			self.assertSameRows(text)
+			self.assertSameRows(text, [0, 12, 30, 0, 0, 0, 0, 0])
+
+	def testRandomRows(self):
+		rand = random.Random(3)
+		words = [u'Avgift', u'100', u'kr', u'x', u'Ab', u'-', u'a- b', u'1 000']
+		for k in range(2000):
+			lines = []
+			for i in range(rand.randint(1, 5)):
+				lines.append(u''.join([rand.choice([u' ', u'  ', u'   ', u'       ', 
+													rand.choice(words)])
+									   for j in range(rand.randint(0, 12))]))
+			tabstops = rand.choice([None, [0, 12, 30, 0, 0, 0, 0, 0],
+									[0, 5, 9, 20, 0, 0, 0, 0, 0, 0]])
+			self.assertSameRows(u'\r\n'.join(lines), tabstops)
+
+# The markers as andringsDatum found them before, one regex for each
+reRevokeDate 		= re.compile(ur'/(?:Rubriken u|U)pphr att glla U:(\d+)-(\d+)-(\d+)/') 
+reRevokeAuth		= re.compile(ur'/Upphr att glla U:(den dag regeringen bestmmer)/')
+reEntryIntoForceDate = re.compile(ur'/(?:Rubriken t|T)rder i kraft I:(\d+)-(\d+)-(\d+)/')
+reEntryIntoForceAuth = re.compile(ur'/Trder i kraft I:(den dag regeringen bestmmer)/')
+
+def oldAndringsDatum(line, match, regexes):
+	"""andringsDatum as it was, regexes is the order that the dict of
+	them had"""
+	dates = {'ikrafttrader'	: None,
+			 'upphor'		: None }
+
+	for (regex, key) in regexes:
+		if match:
+			m = regex.match(line)
+		else:
+			m = regex.search(line)
+		if m:
+			if len(m.groups()) == 3:
+				dates[key] = datetime(int(m.group(1)),
+									  int(m.group(2)),
+									  int(m.group(3)))
+			else:
+				dates[key] = m.group(1)
+			line = regex.sub(u'', line)
+
+	return (line.strip(), dates['upphor'], dates['ikrafttrader'])
+
+class TestAndringsDatum(unittest.TestCase):
+
+	lines = [u'/Upphr att glla U:2011-01-01/ 3  Avgift tas ut.',
+			 u'/Trder i kraft I:2011-01-01/ 3  Avgift tas ut.',
+			 u'/Trder i kraft I:den dag regeringen bestmmer/ 3 ',
+			 u'/Upphr att glla U:den dag regeringen bestmmer/ Avgift',
+			 u'4 kap. Om avgifter /Upphr att glla U:2011-07-01/',
+			 u'/Rubriken upphr att glla U:2011-07-01/',
+			 u'/Rubriken trder i kraft I:2011-07-01/',
+			 u'/Trder i kraft I:2011-01-01/ Avgift   100 kr /Upphr att glla U:2012-01-01/',
+			 u'/Upphr att glla U:2011-01-01/ /Trder i kraft I:2011-01-01/ 1 ',
+			 u'/Upphr att glla U:2011-01-01//Trder i kraft I:2011-01-01/ 1 ',
+			 u'/Trder i kraft I:2011-01-01//Upphr att glla U:den dag regeringen bestmmer/',
+			 u'Avgift   100 kr /r',
+			 u'Avgift   100 kr']
+
+	def setUp(self):
+		self.parser = SFS.SFSParser()
+		self.regexes = [(reRevokeDate, 'upphor'),
+						(reRevokeAuth, 'upphor'),
+						(reEntryIntoForceDate, 'ikrafttrader'),
+						(reEntryIntoForceAuth, 'ikrafttrader')]
+
+	def oldResults(self, line, match):
+		"""The results of the old code for each order of the dict"""
+		return set([oldAndringsDatum(line, match, regexes) 
+					for regexes in permutations(self.regexes)])
+
+	def testSameAsOld(self):
+		for match in (False, True):
+			for line in self.lines:
+				self.assertTrue(self.parser.andringsDatum(line, match) in 
+								self.oldResults(line, match), line)
+
+	def testMatchLeavesLaterMarker(self):
+		# The old code removed the later marker too, the dates are the same
+		line = u'/Upphr att glla U:2011-01-01/ Avgift /Upphr att glla U:2011-01-01/'
+		self.assertEqual(self.parser.andringsDatum(line, True),
+						 (u'Avgift /Upphr att glla U:2011-01-01/', 
+						  datetime(2011, 1, 1), None))
+		self.assertEqual(self.oldResults(line, True),
+						 set([(u'Avgift', datetime(2011, 1, 1), None)]))
+
+class TestHeadingMatcher(unittest.TestCase):
+
+	headings = SFS.SFSParser.overgangsRubriker
+
+	def oldMatch(self, line):
+		"""The heading as isOvergangsbestammelser found it before"""
+		if line in self.headings:
+			return line
+		fuzz = difflib.get_close_matches(line, self.headings, 1, 0.9)
+		if fuzz:
+			return fuzz[0]
+		return None
+
+	def lines(self):
+		"""The headings and other lines with a few chars changed"""
+		rand = random.Random(2)
+		chars = u'abcdefghijklmnopqrstuvwxyzI- .'
+		lines = []
+		for i in range(5000):
+			l = list(rand.choice(list(self.headings) + 
+								 [u'Bilaga 1', u'1  Denna lag trder i kraft den 1 januari 2010.']))
+			for j in range(rand.randint(0, 6)):
+				op = rand.randint(0, 2)
+				k = rand.randint(0, len(l))
+				if op == 0:
+					l.insert(k, rand.choice(chars))
+				elif l and op == 1:
+					del l[min(k, len(l) - 1)]
+				elif l:
+					l[min(k, len(l) - 1)] = rand.choice(chars)
+			lines.append(u''.join(l))
+		# Up to and past the longest line that can be close
+		for h in self.headings:
+			lines.extend([h + u'x' * n for n in range(12)])
+		return lines
+
+	def testSameAsOld(self):
+		# A small size to have the matches cleared a few times
+		matcher = SFS.HeadingMatcher(self.headings, size=100)
+		found = 0
+		for line in self.lines() + self.lines():
+			old = self.oldMatch(line)
+			self.assertEqual(matcher.match(line), old, line)
+			found += old is not None
+		self.assertTrue(found)
+
+if __name__ == '__main__':
+	unittest.main()
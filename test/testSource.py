@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- coding: iso-8859-1 -*-
+"""Tests for the controller base class, run from the root of the repo
+with python -m unittest discover -s test"""
+
+#Libs
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+#Own libs
+import config
+import Source
+
+class RecordingJournal(object):
+	def __init__(self):
+		self.done = []
+		self.failed = {}
+
+	def finish(self, id):
+		self.done.append(id)
+
+	def fail(self, id, error):
+		self.failed[id] = error
+
+class PoolController(Source.Controller):
+	"""A file is parsed fine, fails, kills its worker or never finishes,
+	depending on its name"""
+	def _get_module_dir(self):
+		return 'test'
+
+	def Parse(self, f):
+		if f.startswith('die'):
+			os._exit(1)
+		elif f.startswith('hang'):
+			time.sleep(60)
+		elif f.startswith('fail'):
+			raise ValueError(f)
+
+class TestPool(unittest.TestCase):
+
+	def setUp(self):
+		self.config = (config.processes, config.workerTimeout, config.benchmark)
+		config.processes = 2
+		config.workerTimeout = 2
+		config.benchmark = 0
+
+	def tearDown(self):
+		(config.processes, config.workerTimeout, config.benchmark) = self.config
+
+	def runPool(self, files):
+		ctrl = PoolController()
+		journal = RecordingJournal()
+		started = time.time()
+		ctrl._runPool(files, ctrl.Parse, journal)
+		return (journal, time.time() - started)
+
+	def testAllDone(self):
+		files = ['ok%d' % i for i in range(20)] + ['fail1']
+		(journal, seconds) = self.runPool(files)
+		self.assertEqual(sorted(journal.done), sorted(files[:-1]))
+		self.assertEqual(journal.failed.keys(), ['fail1'])
+		self.assertTrue('ValueError' in journal.failed['fail1'])
+
+	def testLostWorkers(self):
+		# A dead worker is replaced and the other files are done, the 
+		# lost ones are given up together after one timeout
+		files = ['die1', 'hang1', 'die2'] + ['ok%d' % i for i in range(20)]
+		(journal, seconds) = self.runPool(files)
+		self.assertEqual(sorted(journal.done), sorted(files[3:]))
+		self.assertEqual(sorted(journal.failed.keys()), sorted(files[:3]))
+		self.assertTrue(seconds < 2 * config.workerTimeout)
+
+if __name__ == '__main__':
+	unittest.main()
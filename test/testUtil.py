@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# -*- coding: iso-8859-1 -*-
+"""Tests for the utility functions, run from the root of the repo with
+python -m unittest discover -s test"""
+
+#Libs
+import os
+import sys
+import unittest
+from tempfile import mktemp
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+#Own libs
+import config
+import Util
+import SFS
+
+def hasXsltproc():
+	return bool([d for d in os.environ.get('PATH', '').split(os.pathsep)
+				 if os.path.exists(os.path.join(d, 'xsltproc'))])
+
+@unittest.skipIf(Util.etree is None or not hasXsltproc(),
+				 'needs both lxml and xsltproc')
+class TestTransform(unittest.TestCase):
+	"""lxml and xsltproc must give the same HTML"""
+
+	stylesheet = os.path.abspath('xsl/sfs.xsl')
+
+	def setUp(self):
+		self.lxml = config.lxml
+		self.files = []
+
+	def tearDown(self):
+		config.lxml = self.lxml
+		for f in self.files:
+			if os.path.exists(f):
+				os.unlink(f)
+
+	def tempFile(self, data=None):
+		f = mktemp()
+		self.files.append(f)
+		if data is not None:
+			out = open(f, 'wb')
+			out.write(data)
+			out.close()
+		return f
+
+	def parsed(self, f):
+		files = {'sfst': ['data/sfs/dl/sfst/%s.html' % f],
+				 'sfsr': ['data/sfs/dl/sfsr/%s.html' % f]}
+		return SFS.SFSParser().Parse(f, files)
+
+	def transform(self, infile, lxml):
+		config.lxml = lxml
+		outfile = self.tempFile()
+		Util.transform(self.stylesheet, infile, outfile, validate=False)
+		return open(outfile, 'rb').read()
+
+	def testSameResult(self):
+		# The rdf-mini.xml files that sfs.xsl reads with document() are
+		# only there after a full run, both must work without them
+		for f in ('2009/1', '2009/2'):
+			infile = self.tempFile(self.parsed(f))
+			self.assertEqual(self.transform(infile, True),
+							 self.transform(infile, False))
+
+	def testMissingDocument(self):
+		stylesheet = self.tempFile(
+			'<xsl:stylesheet version="1.0" '
+			'xmlns:xsl="http://www.w3.org/1999/XSL/Transform">'
+			'<xsl:template match="/"><out n="{count(document(\'nothere.xml\')/*)}"/>'
+			'</xsl:template></xsl:stylesheet>')
+		infile = self.tempFile('<in/>')
+		self.stylesheet = stylesheet
+		self.assertEqual(self.transform(infile, True),
+						 self.transform(infile, False))
+
+if __name__ == '__main__':
+	unittest.main()